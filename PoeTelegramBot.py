@@ -2,20 +2,38 @@ import logging
 import poe
 import os
 import json
+import base64
+import re
+import hashlib
+import hmac
 import random
 import time
-import shutil
+import asyncio
+import functools
+import contextlib
+import sqlite3
+import threading
+import signal
+import subprocess
+import sys
+import tempfile
+import httpx
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from BingImageCreator import ImageGen
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, MessageEntity
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     filters,
     MessageHandler,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CommandHandler,
     ContextTypes,
     CallbackContext,
     CallbackQueryHandler,
+    TypeHandler,
 )
 
 # Load environment variables from .env file
@@ -24,8 +42,6 @@ load_dotenv()
 # Get environment variables
 TELEGRAM_TOKEN = os.getenv("BOT_TOKEN")
 POE_COOKIE = os.getenv("POE_COOKIE")
-ALLOWED_USERS = os.getenv("ALLOWED_USERS")
-ALLOWED_CHATS = os.getenv("ALLOWED_CHATS")
 
 # Retrieve the Bing auth_cookie from the environment variables
 auth_cookie = os.getenv("BING_AUTH_COOKIE")
@@ -33,7 +49,22 @@ auth_cookie = os.getenv("BING_AUTH_COOKIE")
 # Check if environment variables are set
 if not TELEGRAM_TOKEN:
     raise ValueError("Telegram bot token not set")
-if not POE_COOKIE:
+
+# A server with the OpenAI API (e.g. a local llama.cpp, vLLM or Ollama server) can answer some or all models,
+# POE_COOKIE isn't needed when it answers all of them
+openai_base_url = os.getenv("OPENAI_BASE_URL")
+openai_api_key = os.getenv("OPENAI_API_KEY")
+# The models the server answers, the other models are answered by Poe. The server's list is used if not set.
+openai_models = [model.strip() for model in os.getenv("OPENAI_MODELS", "").split(",") if model.strip()]
+# Seconds the server may send nothing before the request is given up
+openai_timeout = float(os.getenv("OPENAI_TIMEOUT", "60"))
+# Model used by /imagine if IMAGE_BACKEND is "openai", and the seconds it may take to generate the images
+openai_image_model = os.getenv("OPENAI_IMAGE_MODEL")
+openai_image_timeout = float(os.getenv("OPENAI_IMAGE_TIMEOUT", "300"))
+# Which backend generates the /imagine images, "bing" or "openai"
+image_backend_name = os.getenv("IMAGE_BACKEND", "bing").lower()
+
+if not POE_COOKIE and not openai_base_url:
     raise ValueError("POE.com cookie not set")
 
 logging.basicConfig(
@@ -51,79 +82,1918 @@ poe_headers = os.getenv("POE_HEADERS")
 if poe_headers:
     poe.headers = json.loads(poe_headers)
 
-client = poe.Client(POE_COOKIE)
+# POE_COOKIE can hold several comma-separated cookies, chats are spread over one client per cookie
+poe_cookies = [cookie.strip() for cookie in (POE_COOKIE or "").split(",") if cookie.strip()]
+# Maximum number of Poe clients connected at the same time
+max_poe_clients = int(os.getenv("MAX_POE_CLIENTS", str(len(poe_cookies))))
 
 # Get the default model from the .env file
 default_model = os.getenv("DEFAULT_MODEL")
 
 # Set the default model
-selected_model = default_model if default_model else "capybara"
+if not default_model:
+    if poe_cookies:
+        default_model = "capybara"
+    elif openai_models:
+        default_model = openai_models[0]
+    else:
+        raise ValueError("DEFAULT_MODEL or OPENAI_MODELS has to be set when POE_COOKIE isn't")
+
+# Seconds the list of bots/models shown by /select is kept before it's downloaded again
+model_cache_ttl = float(os.getenv("MODEL_CACHE_TTL", "3600"))
+
+# Maximum number of /imagine images downloaded at the same time, and seconds until a download is given up
+image_download_concurrency = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "8"))
+image_download_timeout = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "30"))
+
+# Answer repeated questions to the same model from a cache. Chats can turn it on or off with /cache,
+# RESPONSE_CACHE sets whether it's on by default.
+response_cache_default = os.getenv("RESPONSE_CACHE", "false").lower() in ("true", "1", "yes")
+# Maximum number of cached answers, and seconds an answer is cached for
+response_cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+response_cache_ttl = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# Number of previous chat log messages that have to match as well for a cached answer to be used. Without them, a
+# follow-up like "why?" would get the answer another chat got for its own conversation.
+response_cache_context = int(os.getenv("RESPONSE_CACHE_CONTEXT", "2"))
+# Messages containing this are always sent to the model
+response_cache_bypass = "#nocache"
+
+# Minimum number of seconds between two "not allowed" replies in the same chat
+access_denied_interval = float(os.getenv("ACCESS_DENIED_INTERVAL", "60"))
+
+# Maximum number of chats kept in memory, and seconds after which an unused chat is forgotten
+max_sessions = int(os.getenv("MAX_SESSIONS", "1000"))
+session_idle_timeout = float(os.getenv("SESSION_IDLE_TIMEOUT", "86400"))
+
+# Number of worker threads used for the blocking Poe/Bing calls
+poe_workers = int(os.getenv("POE_WORKERS", "8"))
+# Number of updates that are processed at the same time
+concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# Edit the "Working..." message while the reply is being generated instead of waiting for the full reply
+stream_replies = os.getenv("STREAM_REPLIES", "true").lower() not in ("false", "0", "no")
+# Minimum number of seconds between two edits of the same message (Telegram rate limits message edits)
+stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Every message is sent together with the chat log, which is kept within these limits. Older messages are summarized.
+max_messages = int(os.getenv("MAX_MESSAGES", "20"))
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Model used to summarize old messages, "none" shortens them instead. The summary is sent after a chat break, which
+# clears the Poe conversation with that model for every chat on the account, so only set a model that isn't used for
+# chatting. A server with the OpenAI API keeps no conversations, so without Poe the default model summarizes.
+summary_model = os.getenv("SUMMARY_MODEL", "none" if poe_cookies else default_model)
+# Where the chat history is saved: "file" (one append-only log per chat), "sqlite" or "none" (memory only)
+history_backend = os.getenv("HISTORY_BACKEND", "file").lower()
+# Directory for the "file" backend, or database file for the "sqlite" backend
+history_path = os.getenv("HISTORY_PATH", "chat_history.db" if history_backend == "sqlite" else "chat_logs")
+# Seconds between two writes of the new chat history to disk
+history_flush_interval = float(os.getenv("HISTORY_FLUSH_INTERVAL", "5"))
+# File the settings of the chats (selected model, response cache) and the cookies set with /setcookie are saved to,
+# so they survive a restart ("none" to not save them), and seconds between two saves
+session_snapshot_path = os.getenv("SESSION_SNAPSHOT_PATH", "sessions.json")
+session_snapshot_interval = float(os.getenv("SESSION_SNAPSHOT_INTERVAL", "30"))
+
+# Maximum number of messages waiting in a chat while the bot is still answering, and number of chats answered at the same time
+queue_max_depth = int(os.getenv("QUEUE_MAX_DEPTH", "5"))
+max_concurrent_generations = int(os.getenv("MAX_CONCURRENT_GENERATIONS", str(poe_workers)))
+# Number of threads reading the replies of the Poe models. A stopped reply is still read to its end, so there are
+# more of them than chats answered at the same time.
+stream_workers = int(os.getenv("STREAM_WORKERS", str(2 * max_concurrent_generations)))
+
+# Poe requests per minute sent with each cookie and to each model (0 for no limit). Bursts of up to POE_BURST requests
+# aren't delayed, so the bot only waits when it's actually sending too many requests.
+poe_cookie_rate = float(os.getenv("POE_COOKIE_RATE", "20"))
+poe_model_rate = float(os.getenv("POE_MODEL_RATE", "30"))
+poe_burst = int(os.getenv("POE_BURST", "3"))
+# Number of times a failed Poe or Telegram request is tried again, waiting about RETRY_BASE_DELAY seconds, then twice as long, ...
+max_retries = int(os.getenv("MAX_RETRIES", "2"))
+retry_base_delay = float(os.getenv("RETRY_BASE_DELAY", "1"))
+# After this many failed Poe requests in a row with a cookie or to a model, its requests fail right away for CIRCUIT_BREAKER_COOLDOWN seconds
+circuit_breaker_threshold = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "5"))
+circuit_breaker_cooldown = float(os.getenv("CIRCUIT_BREAKER_COOLDOWN", "60"))
+
+# Telegram allows about one message per second in a chat, 20 per minute in a group and 30 per second in total.
+# Messages and edits are paced to stay below these limits, short bursts of up to 3 messages in a chat aren't delayed.
+telegram_global_rate = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+telegram_chat_interval = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+telegram_group_interval = float(os.getenv("TELEGRAM_GROUP_INTERVAL", "3"))
+
+# Models that answer instead when the selected model fails or doesn't start answering within FIRST_CHUNK_TIMEOUT seconds,
+# tried in this order unless one of them has been slow or failing lately
+fallback_models = [model.strip() for model in os.getenv("FALLBACK_MODELS", "").split(",") if model.strip()]
+first_chunk_timeout = float(os.getenv("FIRST_CHUNK_TIMEOUT", "30"))
+# Replies that take longer than this many seconds in total are cut off
+reply_timeout = float(os.getenv("REPLY_TIMEOUT", "300"))
+
+# Port of the local HTTP server serving the metrics on /metrics (disabled if not set), and the address it listens on
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+# Seconds between two metrics summaries in the log (disabled if 0)
+metrics_log_interval = float(os.getenv("METRICS_LOG_INTERVAL", "0"))
+
+# Receive the updates through a webhook at this public URL instead of polling for them (polling if not set)
+webhook_url = os.getenv("WEBHOOK_URL")
+# Address and port the webhook server listens on, e.g. behind a reverse proxy that forwards WEBHOOK_URL to it
+webhook_host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+webhook_port = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Telegram sends this secret with every update, requests without it are rejected. Derived from the bot token if not set.
+webhook_secret = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode("utf-8")).hexdigest()
+# Maximum number of received updates that are waiting or being processed. Further updates are refused, and Telegram
+# sends them again later.
+webhook_queue_size = int(os.getenv("WEBHOOK_QUEUE_SIZE", "256"))
+# Number of processes answering the updates. With more than one, this process only receives the updates and passes
+# every chat's updates to the same worker process, which listens on WEBHOOK_PORT + 1 + its number.
+webhook_workers = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# The number of a worker process, set for the worker processes when they are started
+webhook_worker = os.getenv("WEBHOOK_WORKER")
+if webhook_worker is not None:
+    webhook_worker = int(webhook_worker)
+    # Every worker serves its own metrics and saves its own chats
+    if metrics_port:
+        metrics_port += webhook_worker
+    if session_snapshot_path.lower() != "none":
+        root, extension = os.path.splitext(session_snapshot_path)
+        session_snapshot_path = f"{root}-{webhook_worker}{extension}"
+    # The rate limits are for the whole bot, every worker gets its share. A chat's own limits stay as they are,
+    # as all of its updates go to the same worker.
+    poe_cookie_rate /= webhook_workers
+    poe_model_rate /= webhook_workers
+    telegram_global_rate /= webhook_workers
+
+# The poe and BingImageCreator clients are synchronous, so they run on this pool to keep the event loop free
+executor = ThreadPoolExecutor(max_workers=poe_workers, thread_name_prefix="backend")
+# The replies are read on a pool of their own, so replies that are still being read don't delay the other calls
+stream_executor = ThreadPoolExecutor(max_workers=stream_workers, thread_name_prefix="stream")
+
+async def run_blocking(func, *args, **kwargs):
+    # Run a blocking function on the worker pool and wait for its result without blocking other chats
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+def backoff_delay(attempt):
+    # Seconds to wait before trying a failed request again: exponential backoff with jitter, so retries don't arrive together
+    delay = min(60.0, retry_base_delay * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+class TokenBucket:
+    # Allows `rate` requests per second on average, and bursts of up to `capacity` requests
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Take a token and return the seconds until it's available. Tokens can be owed, so waiting requests keep their order.
+        self.refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def hold(self, seconds):
+        # Make the next request wait at least this many seconds
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+class RateLimiter:
+    # A token bucket for every key (cookie or model), allowing per_minute requests per minute
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.buckets = {}
+
+    async def acquire(self, key):
+        if self.rate <= 0:
+            return
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        delay = bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class CircuitOpenError(Exception):
+    pass
+
+class FirstChunkTimeout(TimeoutError):
+    # The model didn't start answering in time
+    pass
+
+class CircuitBreaker:
+    # Makes the requests with a cookie or to a model fail right away while it keeps failing, instead of letting every chat wait
+    # for it. After the cooldown, one request is let through to see if it works again.
+    def __init__(self, threshold, cooldown):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = {}
+        self.open_until = {}
+
+    def check(self, key, name):
+        now = time.monotonic()
+        open_until = self.open_until.get(key)
+        if open_until is None:
+            return
+        if now < open_until:
+            raise CircuitOpenError(f"{name} failed too often, trying again in {open_until - now:.0f} seconds.")
+        # Let this request through and keep the others failing until it's done
+        self.open_until[key] = now + self.cooldown
+
+    def success(self, key):
+        self.failures.pop(key, None)
+        self.open_until.pop(key, None)
+
+    def failure(self, key):
+        self.failures[key] = self.failures.get(key, 0) + 1
+        if self.failures[key] >= self.threshold:
+            self.open_until[key] = time.monotonic() + self.cooldown
+
+    def is_open(self, key):
+        return self.open_until.get(key, 0) > time.monotonic()
+
+    def open_count(self):
+        now = time.monotonic()
+        return sum(open_until > now for open_until in self.open_until.values())
+
+cookie_limiter = RateLimiter(poe_cookie_rate, poe_burst)
+model_limiter = RateLimiter(poe_model_rate, poe_burst)
+backend_breaker = CircuitBreaker(circuit_breaker_threshold, circuit_breaker_cooldown)
+
+class PendingEdit:
+    # An edit of a message that is waiting to be sent. Newer edits of the same message replace its text.
+    def __init__(self, kwargs, previous):
+        self.kwargs = kwargs
+        # The edit of the same message that has to be sent first
+        self.previous = previous
+        self.future = asyncio.get_running_loop().create_future()
+        self.sending = False
+
+class TelegramSender:
+    # Sends the bot's messages and edits. Every chat gets one message or edit per chat_interval seconds on average
+    # (group_interval in groups) and all chats together at most global_rate per second. The edits of a message
+    # are sent one after another, and an edit that is still waiting only sends the newest text.
+    # Requests are tried again after RetryAfter (waiting as long as Telegram asks) and network errors.
+    def __init__(self, global_rate, chat_interval, group_interval, chat_burst=3):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.chat_burst = chat_burst
+        # chat_id -> TokenBucket of the chat
+        self.chats = {}
+        # (chat_id, message_id) -> the message's last PendingEdit
+        self.edits = {}
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 10000:
+                # Forget the chats that could send a burst again anyway
+                for bucket in list(self.chats.values()):
+                    bucket.refill()
+                self.chats = {chat: bucket for chat, bucket in self.chats.items() if bucket.tokens < bucket.capacity}
+            interval = self.group_interval if isinstance(chat_id, int) and chat_id < 0 else self.chat_interval
+            bucket = self.chats[chat_id] = TokenBucket(1 / max(interval, 0.001), self.chat_burst)
+        return bucket
+
+    async def pace(self, chat_id):
+        delay = max(self.chat_bucket(chat_id).reserve(), self.global_bucket.reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def hold(self, chat_id, seconds):
+        # Telegram asked to wait before sending anything else to the chat
+        self.chat_bucket(chat_id).hold(seconds)
+
+    async def request(self, chat_id, call):
+        # BadRequest won't work on another try
+        for attempt in range(max_retries + 1):
+            await self.pace(chat_id)
+            try:
+                return await call()
+            except BadRequest:
+                raise
+            except RetryAfter as e:
+                self.hold(chat_id, e.retry_after)
+                if attempt == max_retries:
+                    raise
+                logging.warning("Telegram asked to wait %s seconds before sending to chat %s", e.retry_after, chat_id)
+            except NetworkError as e:
+                if attempt == max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning("Telegram request failed (%s), trying again in %.1f seconds", str(e), delay)
+                await asyncio.sleep(delay)
+
+    async def send_message(self, bot, chat_id, text, **kwargs):
+        # Plain text that is too long for one message is sent as several messages, the last one is returned
+        limit = max_message_length if kwargs.get("parse_mode") is None else len(text)
+        message = None
+        for start in range(0, max(1, len(text)), max(1, limit)):
+            async def send(piece=text[start:start + limit]):
+                with measure("telegram_send"):
+                    return await bot.send_message(chat_id=chat_id, text=piece, **kwargs)
+            message = await self.request(chat_id, send)
+        return message
+
+    async def send_media_group(self, bot, chat_id, media, **kwargs):
+        async def send():
+            with measure("telegram_send"):
+                return await bot.send_media_group(chat_id=chat_id, media=media, **kwargs)
+        return await self.request(chat_id, send)
+
+    def register_edit(self, key, kwargs):
+        # Edits are registered before anything is awaited, so an edit made later is always sent later.
+        # Returns the edit that sends the text, and whether it's a new edit that still has to be sent.
+        previous = self.edits.get(key)
+        if previous is not None and not previous.sending:
+            # The waiting edit sends this text instead of its own
+            previous.kwargs = kwargs
+            return previous, False
+        edit = self.edits[key] = PendingEdit(kwargs, previous)
+        return edit, True
+
+    async def edit_message_text(self, bot, chat_id, message_id, **kwargs):
+        key = (chat_id, message_id)
+        edit, new = self.register_edit(key, kwargs)
+        if not new:
+            return await asyncio.shield(edit.future)
+        return await self.send_edit(bot, key, edit)
+
+    async def send_edit(self, bot, key, edit):
+        chat_id, message_id = key
+        try:
+            if edit.previous is not None:
+                await asyncio.wait([edit.previous.future])
+                edit.previous = None
+
+            async def send():
+                edit.sending = True
+                with measure("telegram_edit"):
+                    return await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **edit.kwargs)
+
+            result = await self.request(chat_id, send)
+            edit.future.set_result(result)
+            return result
+        except BaseException as e:
+            if not edit.future.done():
+                edit.future.set_exception(e)
+                # Only the edits that were replaced by this one wait for it, don't warn if there are none
+                edit.future.exception()
+            raise
+        finally:
+            if self.edits.get(key) is edit:
+                del self.edits[key]
+
+    def edit_in_background(self, bot, chat_id, message_id, **kwargs):
+        # Edit without waiting, for previews that a newer edit may replace anyway
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                logging.debug("Skipped an edit: %s", str(task.exception()))
+        key = (chat_id, message_id)
+        edit, new = self.register_edit(key, kwargs)
+        if new:
+            asyncio.ensure_future(self.send_edit(bot, key, edit)).add_done_callback(done)
+
+    async def reply(self, bot, chat_id, message_id, pieces, parse_mode="MarkdownV2"):
+        # Show the first piece of a reply in the "working" message and send the rest as new messages, in order
+        try:
+            await self.edit_message_text(bot, chat_id, message_id, text=pieces[0], parse_mode=parse_mode)
+        except BadRequest as e:
+            # A streamed reply without any markup is already shown exactly as it is
+            if "not modified" not in str(e):
+                raise
+        for piece in pieces[1:]:
+            await self.send_message(bot, chat_id, piece, parse_mode=parse_mode)
+
+telegram_sender = TelegramSender(telegram_global_rate, telegram_chat_interval, telegram_group_interval)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+class Gauge:
+    # A value read from `function` whenever the metrics are rendered, with labels `function` returns {labels: value}.
+    # Counters kept elsewhere use kind="counter".
+    def __init__(self, name, help_text, function, kind="gauge", labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.kind = kind
+        self.labels = labels
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.kind}"
+        values = self.function() if self.labels else {(): self.function()}
+        for labels, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        counts = self.values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0])
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        counts[0][index] += 1
+        counts[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels((*self.labels, 'le'), (*labels, bound))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+
+    def summary(self):
+        # labels -> (count, average) for the log summary
+        return {labels: (sum(counts), total / max(1, sum(counts))) for labels, (counts, total) in self.values.items()}
+
+class Metrics:
+    # Collects the bot's metrics and renders them in the Prometheus text format
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+metrics = Metrics()
+handler_seconds = metrics.add(Histogram("poebot_handler_seconds", "Time spent in each Telegram handler.", ("handler",)))
+stage_seconds = metrics.add(Histogram("poebot_stage_seconds", "Time spent in each stage of answering.", ("stage",)))
+errors_total = metrics.add(Counter("poebot_errors_total", "Errors by exception type.", ("exception",)))
+fallbacks_total = metrics.add(Counter("poebot_fallbacks_total", "Replies handed to a fallback model.", ("selected", "model")))
+
+@contextlib.contextmanager
+def measure(stage):
+    # Time a stage of answering a message
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage)
+
+def instrument(name, callback):
+    # Time a handler and count the exceptions it doesn't handle itself
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception as e:
+            errors_total.inc(type(e).__name__)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+# Seconds a client of the webhook or metrics server has to send its request, and seconds the received webhook
+# requests are waited for when stopping
+http_request_timeout = 10
+webhook_drain_timeout = 30
+
+async def read_http_request(reader, max_body_size=0):
+    # Read a minimal HTTP/1.1 request, returns the method, path, headers (with lowercase names) and body.
+    # Raises ValueError for bodies over max_body_size.
+    request_line = (await reader.readline()).decode("latin-1").split() + ["", ""]
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length < 0 or length > max_body_size:
+        raise ValueError(f"Request body of {length} bytes is too large")
+    body = await reader.readexactly(length) if length else b""
+    return request_line[0], request_line[1], headers, body
+
+async def write_http_response(writer, status, body=b"", content_type="text/plain; charset=utf-8"):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
 
-async def start(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-
-    if ALLOWED_CHATS and str(chat_id) not in ALLOWED_CHATS.split(",") and str(user_id) not in ALLOWED_USERS.split(","):
-        # Deny access if the user is not in the allowed users list and the chat is not in the allowed chats list
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Sorry, you are not allowed to use this bot. If you are the one who set up this bot, add your Telegram UserID to the \"ALLOWED_USERS\" environment variable in your .env file, or use it in the \"ALLOWED_CHATS\" you specified."
+async def serve_metrics(reader, writer):
+    # A minimal HTTP/1.1 handler answering GET /metrics
+    try:
+        method, path, headers, body = await asyncio.wait_for(read_http_request(reader), http_request_timeout)
+        if method == "GET" and path.split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        await write_http_response(writer, status, body, "text/plain; version=0.0.4; charset=utf-8")
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def log_metrics(interval):
+    # Log how long every handler and stage took on average
+    while True:
+        await asyncio.sleep(interval)
+        timings = [
+            f"{labels[0]} {count}x {average * 1000:.0f}ms"
+            for histogram in (handler_seconds, stage_seconds)
+            for labels, (count, average) in sorted(histogram.summary().items())
+        ]
+        errors = [f"{labels[0]} {count}" for labels, count in errors_total.values.items()]
+        logging.info("Metrics: %s. Errors: %s", ", ".join(timings) or "nothing yet", ", ".join(errors) or "none")
+
+async def iterate_in_thread(pool, iterator_factory, *args, **kwargs):
+    # Consume a blocking iterator on a thread of the pool and yield its items on the event loop as they arrive.
+    # Once the consumer stops, the rest of the items are still read but dropped. Closing the iterator early would
+    # leave the poe client waiting for the unfinished reply before it sends another message.
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    finished = object()
+    stopped = threading.Event()
+
+    def put(item, error):
+        if not stopped.is_set():
+            loop.call_soon_threadsafe(items.put_nowait, (item, error))
+
+    def produce():
+        try:
+            for item in iterator_factory(*args, **kwargs):
+                put(item, None)
+        except Exception as e:
+            put(finished, e)
+        else:
+            put(finished, None)
+
+    producer = loop.run_in_executor(pool, produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                break
+            yield item
+    finally:
+        stopped.set()
+    await producer
+
+async def backend_chunks(slot, model, message, with_chat_break=False):
+    # Send a message to the backend of the model and yield the new text of every chunk. Poe requests are rate limited
+    # per cookie and model, and a failed request is tried again as long as none of its text was yielded yet.
+    # A model that doesn't start answering within first_chunk_timeout seconds isn't tried again, a fallback model can answer instead.
+    # Every backend yields an empty chunk once it sends the request, the time until then (e.g. connecting the client
+    # or waiting for a thread to read the reply) isn't the model's and doesn't count towards the timeout. A slow model isn't a failing one, so a timeout doesn't
+    # trip the circuit breaker.
+    backend = chat_backends.for_model(model)
+    for attempt in range(max_retries + 1):
+        account = backend.account(slot)
+        backend_breaker.check(("account", account), backend.account_name)
+        backend_breaker.check(("model", model), f"The model {model}")
+        if backend.rate_limited:
+            with measure("rate_limit"):
+                await asyncio.gather(cookie_limiter.acquire(account), model_limiter.acquire(model))
+
+        received = False
+        response = backend.stream(slot, model, message, with_chat_break=with_chat_break)
+        try:
+            await anext(response, None)
+            started = time.perf_counter()
+            try:
+                text_new = await asyncio.wait_for(anext(response, None), first_chunk_timeout)
+            except asyncio.TimeoutError:
+                raise FirstChunkTimeout(f"The model {model} didn't start answering within {first_chunk_timeout:g} seconds.")
+            stage_seconds.observe(time.perf_counter() - started, "first_chunk")
+            if text_new is not None:
+                received = True
+                yield text_new
+                async for text_new in response:
+                    yield text_new
+        except FirstChunkTimeout:
+            raise
+        except Exception as e:
+            backend_breaker.failure(("account", account))
+            backend_breaker.failure(("model", model))
+            if received or attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning("Request to %s failed (%s), trying again in %.1f seconds", model, str(e), delay)
+            await asyncio.sleep(delay)
+        else:
+            backend_breaker.success(("account", account))
+            backend_breaker.success(("model", model))
+            return
+        finally:
+            await response.aclose()
+
+async def collect_response(slot, model, message, with_chat_break=False):
+    # The full response, for when it isn't streamed
+    return "".join([text_new async for text_new in backend_chunks(slot, model, message, with_chat_break=with_chat_break)])
+
+class ModelStats:
+    # Exponentially weighted moving averages of a model's time to the first chunk and of its share of failed requests
+    def __init__(self):
+        self.latency = None
+        self.errors = 0.0
+
+class ModelRouter:
+    # Picks the models that answer a message: the selected model, then the fallback models. A model that has been
+    # failing is only tried after the healthy fallbacks, and the fallbacks are ordered by how fast and reliable they were lately.
+    def __init__(self, fallbacks, alpha=0.2):
+        self.fallbacks = list(fallbacks)
+        self.alpha = alpha
+        self.stats = {}
+        # Selected model -> model that answered its last message in any chat, only for the metrics. Chats answered
+        # at the same time overwrite it, the model that answered a reply is RoutedReply.answered_by.
+        self.active = {}
+
+    def healthy(self, model):
+        stats = self.stats.get(model)
+        return not backend_breaker.is_open(("model", model)) and (stats is None or stats.errors < 0.5)
+
+    def score(self, model):
+        stats = self.stats.get(model)
+        if stats is None or stats.latency is None:
+            return 0.0
+        return stats.latency * (1 + 4 * stats.errors)
+
+    def route(self, model):
+        fallbacks = sorted(
+            (fallback for fallback in self.fallbacks if fallback != model),
+            key=lambda fallback: (not self.healthy(fallback), self.score(fallback)),
         )
+        if self.healthy(model) or not fallbacks or not self.healthy(fallbacks[0]):
+            return [model] + fallbacks
+        return fallbacks + [model]
+
+    def record(self, model, latency=None, failed=False):
+        stats = self.stats.setdefault(model, ModelStats())
+        stats.errors += self.alpha * (failed - stats.errors)
+        if latency is not None:
+            stats.latency = latency if stats.latency is None else stats.latency + self.alpha * (latency - stats.latency)
+
+    def latency_values(self):
+        return {(model,): stats.latency for model, stats in self.stats.items() if stats.latency is not None}
+
+    def error_values(self):
+        return {(model,): stats.errors for model, stats in self.stats.items()}
+
+    def route_values(self):
+        return {(selected, model): 1 for selected, model in self.active.items()}
+
+model_router = ModelRouter(fallback_models)
+
+class RoutedReply:
+    # The reply of the selected model. If it fails or doesn't start answering in time, the next model of the route
+    # answers instead. Once the first text is shown the model can't be changed anymore, answered_by is then the model
+    # whose reply it is.
+    def __init__(self, slot, model, message):
+        self.slot = slot
+        self.model = model
+        self.message = message
+        self.answered_by = None
+
+    def __aiter__(self):
+        return self.chunks()
+
+    async def chunks(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + reply_timeout
+        route = model_router.route(self.model)
+        for index, candidate in enumerate(route):
+            chunks = backend_chunks(self.slot, candidate, self.message)
+            started = time.perf_counter()
+            try:
+                text_new = await anext(chunks, "")
+            except Exception as e:
+                # An open circuit didn't ask the model, so it says nothing about how the model is doing.
+                # A model that didn't answer in time is slow rather than failing.
+                if isinstance(e, FirstChunkTimeout):
+                    model_router.record(candidate, latency=first_chunk_timeout)
+                elif not isinstance(e, CircuitOpenError):
+                    model_router.record(candidate, failed=True)
+                await chunks.aclose()
+                if index == len(route) - 1:
+                    raise
+                logging.warning("%s failed (%s), answering with %s instead", candidate, str(e), route[index + 1])
+                fallbacks_total.inc(self.model, route[index + 1])
+                continue
+
+            model_router.record(candidate, latency=time.perf_counter() - started)
+            model_router.active[self.model] = candidate
+            self.answered_by = candidate
+            try:
+                while text_new is not None:
+                    yield text_new
+                    text_new = await asyncio.wait_for(anext(chunks, None), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                logging.warning("The reply of %s took longer than %g seconds and was cut off", candidate, reply_timeout)
+                yield "\n\n(The reply took too long and was cut off.)"
+            except Exception:
+                model_router.record(candidate, failed=True)
+                raise
+            finally:
+                await chunks.aclose()
+            return
+
+async def stream_reply(context: CallbackContext, chat_id, message_id, text_chunks):
+    # Show the reply in the "working" message while it's being generated and return the full text.
+    # The first chunk is shown right away, later ones are grouped so there is at most one edit every stream_edit_interval seconds.
+    loop = asyncio.get_running_loop()
+    message_text = ""
+    shown_text = ""
+    next_edit = 0.0
+
+    async for text_new in text_chunks:
+        message_text += text_new
+        if not message_text.strip() or loop.time() < next_edit:
+            continue
+
+        # Partial replies are sent as plain text, as unfinished markup can't be parsed. Telegram messages are limited to 4096 characters.
+        # The reading of the chunks goes on while the edit waits in the sender, which only sends the newest preview.
+        preview = message_text[:max_message_length]
+        if preview == shown_text:
+            continue
+        telegram_sender.edit_in_background(context.bot, chat_id, message_id, text=preview)
+        shown_text = preview
+        next_edit = loop.time() + stream_edit_interval
+
+    return message_text
+
+# Telegram doesn't accept messages longer than this
+max_message_length = 4096
+
+# Characters that have to be escaped in MarkdownV2 text, and the ones that have to be escaped inside code.
+# The backslash comes first so the added escapes aren't escaped again. str.replace runs in C and is faster than
+# a single re.sub or str.translate pass over the whole reply, even with one pass per character.
+markdown_text_escapes = tuple((character, "\\" + character) for character in "\\_*[]()~`>#+-=|{}.!")
+markdown_code_escapes = (("\\", "\\\\"), ("`", "\\`"))
+# Code blocks (```language\ncode```) and inline code (`code`), which are kept as code instead of being escaped.
+# A "language" longer than any real one is the first line of the code.
+markdown_code = re.compile(r"```(?:([\w#+.-]{0,64})\n)?(.*?)```|`([^`\n]+)`", re.DOTALL)
+
+def escape_text(text):
+    for character, escaped in markdown_text_escapes:
+        text = text.replace(character, escaped)
+    return text
+
+def escape_code(code):
+    for character, escaped in markdown_code_escapes:
+        code = code.replace(character, escaped)
+    return code
+
+def escape_markdown(text):
+    # Escape a reply for MarkdownV2, keeping its code blocks and inline code
+    if "`" not in text:
+        return escape_text(text)
+    return "".join(markdown_pieces(text, max_length=None))
+
+def split_markdown(text, limit=max_message_length):
+    # Escape a reply for MarkdownV2 and split it into messages of at most `limit` characters.
+    # Messages are split between lines where possible and code blocks are closed and reopened around a split.
+    messages = []
+    current = ""
+    for piece in markdown_pieces(text, max_length=limit):
+        if current and len(current) + len(piece) > limit:
+            messages.append(current)
+            current = ""
+        current += piece
+    messages.append(current)
+    # Telegram doesn't accept messages with only whitespace
+    return [message for message in messages if message.strip()] or messages[:1]
+
+def markdown_pieces(text, max_length):
+    # Yield escaped pieces of a reply. With max_length set, no piece is longer than that and pieces end at line breaks if possible.
+    position = 0
+    for match in markdown_code.finditer(text):
+        yield from escaped_text_pieces(text[position:match.start()], max_length)
+        language, block, inline = match.groups()
+        if inline is not None:
+            code = f"`{escape_code(inline)}`"
+            if max_length is None or len(code) <= max_length:
+                yield code
+            else:
+                yield from escaped_text_pieces(match.group(0), max_length)
+        elif block.strip():
+            yield from code_block_pieces(language or "", block, max_length)
+        else:
+            # An empty code block can't be sent, so it's shown as text
+            yield from escaped_text_pieces(match.group(0), max_length)
+        position = match.end()
+    yield from escaped_text_pieces(text[position:], max_length)
+
+def escaped_text_pieces(text, max_length):
+    if not text:
         return
+    if max_length is None:
+        yield escape_text(text)
+        return
+    for line in text.splitlines(keepends=True):
+        # Every character takes at most two characters once escaped
+        for part in split_long_line(line, max_length // 2):
+            yield escape_text(part)
+
+def code_block_pieces(language, code, max_length):
+    opening = f"```{language}\n"
+    if max_length is None:
+        yield f"{opening}{escape_code(code)}```"
+        return
+    # Split long code blocks between lines into several blocks that fit in a message
+    room = max_length - len(opening) - 3
+    block = ""
+    for line in code.splitlines(keepends=True):
+        for part in split_long_line(line, room // 2):
+            escaped = escape_code(part)
+            if block and len(block) + len(escaped) > room:
+                yield f"{opening}{block}```"
+                block = ""
+            block += escaped
+    yield f"{opening}{block}```"
+
+def split_long_line(line, size):
+    # Split a line into parts of at most `size` characters, at a space if there is one in the second half
+    size = max(1, size)
+    while len(line) > size:
+        cut = line.rfind(" ", size // 2, size) + 1 or size
+        yield line[:cut]
+        line = line[cut:]
+    if line:
+        yield line
+
+def parse_ids(value):
+    # Parse a comma-separated list of Telegram IDs
+    ids = set()
+    for part in (value or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            ids.add(int(part))
+        except ValueError:
+            logging.warning("Ignoring invalid Telegram ID: %s", part)
+    return frozenset(ids)
+
+class AccessControl:
+    # Decides who may use the bot. ALLOWED_USERS and ALLOWED_CHATS are parsed once, and again on reload().
+    def __init__(self, denied_interval):
+        self.denied_interval = denied_interval
+        self.last_denied = {}
+        self.load()
+
+    def load(self):
+        self.users, self.chats = parse_ids(os.getenv("ALLOWED_USERS")), parse_ids(os.getenv("ALLOWED_CHATS"))
+
+    def reload(self):
+        # Read the lists again from the .env file
+        load_dotenv(override=True)
+        self.load()
+
+    def is_allowed(self, chat_id, user_id):
+        # Everyone is allowed if neither list is set, otherwise the chat or the user has to be in its list
+        if not self.users and not self.chats:
+            return True
+        return chat_id in self.chats or user_id in self.users
+
+    def is_admin(self, user_id):
+        # Commands that change the bot's settings are limited to ALLOWED_USERS, if it's set
+        return not self.users or user_id in self.users
+
+    def should_reply(self, chat_id):
+        # Only reply to denied requests once per denied_interval in every chat, so spam doesn't use up our Telegram quota
+        now = time.monotonic()
+        if now - self.last_denied.get(chat_id, float("-inf")) < self.denied_interval:
+            return False
+        if len(self.last_denied) > 10000:
+            self.last_denied = {k: v for k, v in self.last_denied.items() if now - v < self.denied_interval}
+        self.last_denied[chat_id] = now
+        return True
+
+access_control = AccessControl(access_denied_interval)
+
+class FileHistoryBackend:
+    # Saves the history of every chat in its own append-only log file, one JSON encoded message per line
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.log")
+
+    def load(self, chat_id, limit):
+        try:
+            with open(self.path(chat_id), "r", encoding="utf-8") as file:
+                return [json.loads(line) for line in deque(file, maxlen=limit) if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def write(self, chat_id, truncate, lines):
+        with open(self.path(chat_id), "w" if truncate else "a", encoding="utf-8") as file:
+            file.writelines(json.dumps(line) + "\n" for line in lines)
+
+    def close(self):
+        pass
+
+class SQLiteHistoryBackend:
+    # Saves the history of all chats in one SQLite database in WAL mode
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, line TEXT NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS history_chat ON history (chat_id, id)")
+        self.connection.commit()
+
+    def load(self, chat_id, limit):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT line FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT ?", (chat_id, limit)
+            ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def write(self, chat_id, truncate, lines):
+        with self.lock, self.connection:
+            if truncate:
+                self.connection.execute("DELETE FROM history WHERE chat_id = ?", (chat_id,))
+            self.connection.executemany(
+                "INSERT INTO history (chat_id, line) VALUES (?, ?)", [(chat_id, line) for line in lines]
+            )
 
-    await context.bot.send_message(
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def estimate_tokens(text):
+    # Roughly four characters per token, close enough to keep the prompts within budget
+    return len(text) // 4 + 1
+
+class ChatHistory:
+    # Keeps the last messages of every chat in memory, with their approximate number of tokens. A chat's history is
+    # loaded from the backend the first time it's used, and changes are written back in batches by flush().
+    def __init__(self, backend, load_limit):
+        self.backend = backend
+        self.load_limit = load_limit
+        self.chats = {}
+        self.tokens = {}
+        self.loading = {}
+        # chat_id -> [truncate the saved history first, lines to append]
+        self.pending = {}
+        # Flushes run one after another, so a later flush never writes before an earlier one
+        self.flush_lock = asyncio.Lock()
+
+    async def get(self, chat_id):
+        if chat_id in self.chats:
+            return self.chats[chat_id]
+        if chat_id not in self.loading:
+            self.loading[chat_id] = asyncio.ensure_future(self.load(chat_id))
+        try:
+            return await asyncio.shield(self.loading[chat_id])
+        finally:
+            self.loading.pop(chat_id, None)
+
+    async def load(self, chat_id):
+        with measure("history_load"):
+            lines = await run_blocking(self.backend.load, chat_id, self.load_limit) if self.backend else []
+        if chat_id not in self.chats:
+            self.chats[chat_id] = deque(lines)
+            self.tokens[chat_id] = sum(estimate_tokens(line) for line in lines)
+        return self.chats[chat_id]
+
+    def append(self, chat_id, line):
+        self.chats.setdefault(chat_id, deque()).append(line)
+        self.tokens[chat_id] = self.tokens.get(chat_id, 0) + estimate_tokens(line)
+        self.pending.setdefault(chat_id, [False, []])[1].append(line)
+
+    def replace(self, chat_id, lines):
+        # Replace the whole history, in place so sessions holding on to the chat's history see the change
+        history = self.chats.setdefault(chat_id, deque())
+        history.clear()
+        history.extend(lines)
+        self.tokens[chat_id] = sum(estimate_tokens(line) for line in lines)
+        self.pending[chat_id] = [True, list(lines)]
+
+    def clear(self, chat_id):
+        self.replace(chat_id, [])
+
+    def token_count(self, chat_id):
+        return self.tokens.get(chat_id, 0)
+
+    def forget(self, chat_id):
+        # Drop a chat's history from memory, unless some of it still has to be saved
+        if chat_id not in self.pending:
+            self.chats.pop(chat_id, None)
+            self.tokens.pop(chat_id, None)
+
+    async def flush(self):
+        async with self.flush_lock:
+            pending, self.pending = self.pending, {}
+            if not self.backend:
+                return
+            for chat_id, (truncate, lines) in pending.items():
+                try:
+                    with measure("history_write"):
+                        await run_blocking(self.backend.write, chat_id, truncate, lines)
+                except Exception as e:
+                    logging.error("Failed to save the chat history of chat %s: %s", chat_id, str(e))
+
+    async def run_flusher(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            # Cancelling the flusher lets a running flush finish, so none of its lines are lost
+            await asyncio.shield(self.flush())
+
+    async def close(self):
+        await self.flush()
+        if self.backend:
+            await run_blocking(self.backend.close)
+
+def create_history_backend():
+    if history_backend == "sqlite":
+        return SQLiteHistoryBackend(history_path)
+    if history_backend == "file":
+        return FileHistoryBackend(history_path)
+    if history_backend == "none":
+        return None
+    raise ValueError(f"Unknown HISTORY_BACKEND: {history_backend}")
+
+# Twice max_messages, so a log that wasn't summarized yet is loaded completely
+chat_history = ChatHistory(create_history_backend(), max_messages * 2)
+
+# The first line of a summarized chat log
+summary_prefix = "Summary of the earlier conversation: "
+
+class ContextCompactor:
+    # Keeps every chat log within token_budget and max_lines. When a log grows past them, its oldest messages are
+    # summarized in the background, so answering never waits for it.
+    def __init__(self, token_budget, max_lines, model):
+        self.token_budget = token_budget
+        self.max_lines = max_lines
+        self.model = model
+        self.tasks = {}
+
+    def schedule(self, session):
+        chat_id = session.chat_id
+        if chat_id in self.tasks:
+            return
+        if chat_history.token_count(chat_id) <= self.token_budget and len(session.history) <= self.max_lines:
+            return
+        self.tasks[chat_id] = asyncio.ensure_future(self.compact(session))
+
+    def cancel(self, chat_id):
+        # Stop summarizing a chat log that is being cleared
+        task = self.tasks.get(chat_id)
+        if task is not None:
+            task.cancel()
+
+    async def compact(self, session):
+        try:
+            lines = list(session.history)
+            summary_lines = lines[:1] if lines and lines[0].startswith(summary_prefix) else []
+            summary = summary_lines[0][len(summary_prefix):] if summary_lines else ""
+            messages = lines[len(summary_lines):]
+
+            # Keep the newest messages within half of the limits, and summarize the rest
+            keep, tokens = 0, 0
+            for line in reversed(messages):
+                tokens += estimate_tokens(line)
+                if keep >= self.max_lines // 2 or tokens > self.token_budget // 2:
+                    break
+                keep += 1
+            aged = messages[:len(messages) - keep]
+            if not aged:
+                return
+            old_lines = summary_lines + aged
+            summary = await self.summarize(session, summary, aged)
+
+            # The log may have changed while summarizing. Only replace the old lines if they're still at the start.
+            current = list(session.history)
+            if current[:len(old_lines)] != old_lines:
+                return
+            chat_history.replace(session.chat_id, [summary_prefix + summary] + current[len(old_lines):])
+        except Exception as e:
+            logging.error("Failed to summarize the chat log of chat %s: %s", session.chat_id, str(e))
+        finally:
+            self.tasks.pop(session.chat_id, None)
+
+    async def summarize(self, session, summary, lines):
+        # The summary may use a quarter of the token budget
+        max_characters = self.token_budget
+        if self.model.lower() != "none":
+            try:
+                prompt = (
+                    f"Summarize the following conversation in at most {max_characters // 6} words. "
+                    "Keep names, facts and open questions. Only reply with the summary.\n\n"
+                    + (f"{summary_prefix}{summary}\n" if summary else "")
+                    + "\n".join(lines)
+                )
+                text = await collect_response(session.slot, self.model, prompt, with_chat_break=True)
+                if text.strip():
+                    return " ".join(text.split())[:max_characters]
+            except Exception as e:
+                logging.warning("Summary model failed, shortening the messages instead: %s", str(e))
+
+        # Without a model, keep the start of every message
+        shortened = " ".join(line[:200] for line in ([summary] if summary else []) + lines)
+        return shortened[-max_characters:]
+
+def build_prompt(history, messages):
+    # Send the chat log as a reminder together with the new messages
+    if not history:
+        return messages
+    return "As a reminder, this is our conversation so far:\n" + "\n".join(history) + "\n\n" + messages
+
+
+class PoeClientSlot:
+    # One Poe account of the pool. The client is only created once it's needed.
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.client = None
+        self.lock = asyncio.Lock()
+        self.sessions = 0
+        self.active = 0
+        self.last_used = 0.0
+
+class PoeClientPool:
+    # Spreads the chats over several Poe cookies and keeps at most max_clients clients connected
+    def __init__(self, cookies, max_clients):
+        self.cookies = list(cookies)
+        self.max_clients = max(1, max_clients)
+        self.slots = [PoeClientSlot(cookie) for cookie in self.cookies]
+
+    def assign(self, index=None):
+        # Give a new chat the slot with the fewest chats, or the slot it had before a restart
+        if index is None or not 0 <= index < len(self.slots):
+            index = min(range(len(self.slots)), key=lambda i: self.slots[i].sessions)
+        self.slots[index].sessions += 1
+        return index
+
+    def release(self, index):
+        self.slots[index].sessions -= 1
+
+    async def get(self, index):
+        slot = self.slots[index]
+        while slot.client is None:
+            async with slot.lock:
+                if slot.client is None:
+                    cookie = slot.cookie
+                    new_client = await run_blocking(poe.Client, cookie)
+                    # Only keep the client if the cookie wasn't swapped in the meantime
+                    if slot.cookie == cookie and slot.client is None:
+                        slot.client = new_client
+                        self.enforce_limit(slot)
+                    else:
+                        self.close_client(new_client)
+        return slot.client
+
+    @contextlib.asynccontextmanager
+    async def client(self, index):
+        # Use the client of a slot, it won't be disconnected while in use
+        slot = self.slots[index]
+        slot.active += 1
+        try:
+            yield await self.get(index)
+        finally:
+            slot.active -= 1
+            slot.last_used = time.monotonic()
+
+    def enforce_limit(self, keep):
+        # Disconnect the least recently used idle clients when too many are connected
+        connected = [slot for slot in self.slots if slot.client is not None]
+        idle = sorted((slot for slot in connected if slot is not keep and not slot.active), key=lambda slot: slot.last_used)
+        for slot in idle[:max(0, len(connected) - self.max_clients)]:
+            self.close_client(slot.client)
+            slot.client = None
+
+    async def replace(self, index, cookie):
+        # Connect with the new cookie first, then swap the cookie and client of the slot in one step
+        new_client = await run_blocking(poe.Client, cookie)
+        slot = self.slots[index]
+        old_client = slot.client
+        slot.cookie, slot.client = cookie, new_client
+        self.close_client(old_client)
+
+    def reset(self):
+        # Go back to the cookies from the .env file, clients are reconnected when needed
+        for slot, cookie in zip(self.slots, self.cookies):
+            old_client = slot.client
+            slot.cookie, slot.client = cookie, None
+            self.close_client(old_client)
+
+    def close_client(self, client):
+        if client is not None and hasattr(client, "disconnect_ws"):
+            executor.submit(client.disconnect_ws)
+
+    async def warm_up(self):
+        # Connect the clients one after another in the background, so the first messages after a start don't wait for them
+        for index in range(min(len(self.slots), self.max_clients)):
+            try:
+                await self.get(index)
+            except Exception as e:
+                logging.warning("Could not connect Poe client %s: %s", index, str(e))
+
+client_pool = PoeClientPool(poe_cookies, max_poe_clients)
+
+# The chat backends all have the same methods: stream() yields the new text of a reply as it's generated, closing it
+# stops the request. The handlers only use backend_chunks() and chat_backends, never a backend's client directly.
+def read_reply(client, model, message, with_chat_break):
+    # The new text of every chunk of a Poe reply, after an empty chunk once the thread reading it sends the message
+    yield ""
+    for chunk in client.send_message(model, message, with_chat_break=with_chat_break):
+        yield chunk["text_new"]
+
+class PoeChatBackend:
+    # The Poe accounts of a client pool. Poe keeps a conversation with every bot, which chat breaks and purges clear.
+    account_name = "The Poe account of this chat"
+    rate_limited = True
+    keeps_conversations = True
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def serves(self, model):
+        # Poe answers every model no other backend answers
+        return True
+
+    def slot_count(self):
+        return len(self.pool.slots)
+
+    def assign(self, index=None):
+        return self.pool.assign(index)
+
+    def release(self, index):
+        self.pool.release(index)
+
+    def account(self, slot):
+        return self.pool.slots[slot].cookie
+
+    async def stream(self, slot, model, message, with_chat_break=False):
+        async with self.pool.client(slot) as client:
+            async for text_new in iterate_in_thread(stream_executor, read_reply, client, model, message, with_chat_break):
+                yield text_new
+
+    async def bot_names(self, slot, refresh=False):
+        async with self.pool.client(slot) as client:
+            if refresh:
+                return await run_blocking(download_bot_names, client)
+            # The client already downloaded the list when it connected
+            return client.bot_names
+
+    async def purge(self, slot, model):
+        async with self.pool.client(slot) as client:
+            await run_blocking(client.purge_conversation, model)
+
+    async def chat_break(self, slot, model):
+        async with self.pool.client(slot) as client:
+            await run_blocking(client.send_chat_break, model)
+
+    async def warm_up(self):
+        await self.pool.warm_up()
+
+class OpenAIServer:
+    # The HTTP connection to a server with the OpenAI API, created when it's first used
+    def __init__(self, base_url, api_key, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.timeout = timeout
+        self.http_client = None
+
+    def client(self):
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                timeout=httpx.Timeout(self.timeout, connect=10),
+            )
+        return self.http_client
+
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+
+class OpenAIChatBackend:
+    # The chat completions of a server with the OpenAI API. It keeps no conversations, the chat log is sent along
+    # with every message anyway. All chats share the server, so the slots don't matter.
+    account_name = "The model server"
+    rate_limited = False
+    keeps_conversations = False
+
+    def __init__(self, server, models):
+        self.server = server
+        self.models = list(models)
+        # Filled from the server's list if no models are configured
+        self.listed = []
+
+    def serves(self, model):
+        return model in (self.models or self.listed)
+
+    def slot_count(self):
+        return 1
+
+    def assign(self, index=None):
+        return 0
+
+    def release(self, index):
+        pass
+
+    def account(self, slot):
+        return self.server.base_url
+
+    async def stream(self, slot, model, message, with_chat_break=False):
+        # The reply is streamed as server-sent events, closing the response stops the generation on the server
+        body = {"model": model, "messages": [{"role": "user", "content": message}], "stream": True}
+        yield ""
+        async with self.server.client().stream("POST", "/chat/completions", json=body) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                text_new = (choices[0].get("delta") or {}).get("content")
+                if text_new:
+                    yield text_new
+
+    async def bot_names(self, slot, refresh=False):
+        if not self.models and (refresh or not self.listed):
+            response = await self.server.client().get("/models")
+            response.raise_for_status()
+            self.listed = [model["id"] for model in response.json().get("data", [])]
+        return {model: model for model in self.models or self.listed}
+
+    async def purge(self, slot, model):
+        pass
+
+    async def chat_break(self, slot, model):
+        pass
+
+    async def warm_up(self):
+        # Learn which models the server answers before the first message
+        try:
+            await self.bot_names(0)
+        except (httpx.HTTPError, ValueError) as e:
+            logging.warning("Could not list the models of %s: %s", self.server.base_url, str(e))
+
+class ChatBackends:
+    # Picks the backend that answers a model. The first backend that serves a model answers it, otherwise the last one.
+    # The chats' slots belong to the last backend.
+    def __init__(self, backends):
+        self.backends = list(backends)
+
+    def for_model(self, model):
+        for backend in self.backends:
+            if backend.serves(model):
+                return backend
+        return self.backends[-1]
+
+    def slot_count(self):
+        return self.backends[-1].slot_count()
+
+    def assign(self, index=None):
+        return self.backends[-1].assign(index)
+
+    def release(self, index):
+        self.backends[-1].release(index)
+
+    def accounts(self, slot):
+        return tuple(backend.account(slot) for backend in self.backends)
+
+    async def bot_names(self, slot, refresh=False):
+        # The models of all backends together. A backend that can't list its models leaves them out, the list only
+        # fails if no backend answers.
+        bot_names = {}
+        results = await asyncio.gather(*(backend.bot_names(slot, refresh) for backend in self.backends), return_exceptions=True)
+        for backend, names in zip(self.backends, results):
+            if isinstance(names, Exception):
+                logging.warning("Could not list the models of %s: %s", type(backend).__name__, str(names))
+                continue
+            bot_names.update(names)
+        if not bot_names:
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                raise errors[0]
+        return bot_names
+
+    async def warm_up(self):
+        await asyncio.gather(*(backend.warm_up() for backend in self.backends))
+
+def create_chat_backends():
+    backends = []
+    if openai_server is not None:
+        backends.append(OpenAIChatBackend(openai_server, openai_models))
+    if poe_cookies:
+        backends.append(PoeChatBackend(client_pool))
+    return ChatBackends(backends)
+
+openai_server = OpenAIServer(openai_base_url, openai_api_key, openai_timeout) if openai_base_url else None
+chat_backends = create_chat_backends()
+
+class ChatSession:
+    # Everything the bot remembers about a chat
+    def __init__(self, chat_id, model, history, slot):
+        self.chat_id = chat_id
+        self.model = model
+        self.history = history
+        self.slot = slot
+        self.cache_enabled = response_cache_default
+        self.last_used = time.monotonic()
+
+class SessionManager:
+    # Keeps the sessions of recently used chats, forgetting the least recently used ones
+    def __init__(self, max_sessions, idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+
+    async def get(self, chat_id):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            history = await chat_history.get(chat_id)
+            # The session may have been created while the history was loading
+            session = self.sessions.get(chat_id)
+            if session is None:
+                # Restore the settings the chat had before a restart
+                state = session_snapshots.pop(chat_id)
+                session = ChatSession(chat_id, default_model, history, chat_backends.assign(state and state[2]))
+                if state:
+                    session.model, session.cache_enabled = state[0], state[1]
+                self.sessions[chat_id] = session
+        self.sessions.move_to_end(chat_id)
+        session.last_used = time.monotonic()
+        self.evict()
+        return session
+
+    def evict(self):
+        idle_since = time.monotonic() - self.idle_timeout
+        while self.sessions:
+            chat_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and session.last_used > idle_since:
+                break
+            self.remove(chat_id)
+
+    def remove(self, chat_id):
+        session = self.sessions.pop(chat_id)
+        chat_backends.release(session.slot)
+        chat_history.forget(chat_id)
+
+    def reset(self):
+        for chat_id in list(self.sessions):
+            self.remove(chat_id)
+
+sessions = SessionManager(max_sessions, session_idle_timeout)
+
+def cookie_digest(cookie):
+    return hashlib.sha256(cookie.encode("utf-8")).hexdigest()[:16] if cookie else ""
+
+class SessionSnapshots:
+    # Saves the settings of the chats and the cookies set with /setcookie to one compact JSON file. It's written to a
+    # temporary file that replaces the old one, so a crash never leaves a half-written snapshot behind.
+    def __init__(self, path):
+        self.path = path
+        # chat_id -> [model, cache_enabled, slot, last used (unix time)] of the chats that weren't used since the start
+        self.chats = {}
+        self.written = None
+        self.save_lock = asyncio.Lock()
+
+    async def restore(self):
+        # Restore the cookies. The chats are only restored when they're used, so the bot can start right away.
+        global auth_cookie
+        if not self.path:
+            return
+        try:
+            data = await run_blocking(self.read)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error("Could not read the session snapshot %s: %s", self.path, str(e))
+            return
+
+        forgotten_before = time.time() - session_idle_timeout
+        self.chats = {int(chat_id): state for chat_id, state in data.get("chats", {}).items() if state[3] > forgotten_before}
+        # A cookie set with /setcookie is only restored if the cookie in the .env file is still the one it replaced
+        for slot, saved in zip(client_pool.slots, data.get("cookies", ())):
+            if saved and saved[0] == cookie_digest(slot.cookie):
+                slot.cookie = saved[1]
+        saved = data.get("bing")
+        if saved and saved[0] == cookie_digest(os.getenv("BING_AUTH_COOKIE")):
+            auth_cookie = saved[1]
+        logging.info("Restored the session snapshot with %s chats", len(self.chats))
+
+    def read(self):
+        with open(self.path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def pop(self, chat_id):
+        return self.chats.pop(chat_id, None)
+
+    def collect(self):
+        wall_clock = time.time() - time.monotonic()
+        chats = {str(chat_id): state for chat_id, state in self.chats.items()}
+        for chat_id, session in sessions.sessions.items():
+            chats[str(chat_id)] = [session.model, session.cache_enabled, session.slot, int(wall_clock + session.last_used)]
+        env_bing_cookie = os.getenv("BING_AUTH_COOKIE")
+        return {
+            "chats": chats,
+            "cookies": [
+                [cookie_digest(cookie), slot.cookie] if slot.cookie != cookie else None
+                for slot, cookie in zip(client_pool.slots, client_pool.cookies)
+            ],
+            "bing": [cookie_digest(env_bing_cookie), auth_cookie] if auth_cookie != env_bing_cookie else None,
+        }
+
+    async def save(self):
+        # Write the snapshot if anything changed since the last one
+        if not self.path:
+            return
+        # An older snapshot must not replace a newer one
+        async with self.save_lock:
+            data = json.dumps(self.collect(), separators=(",", ":"))
+            if data == self.written:
+                return
+            with measure("snapshot_write"):
+                await run_blocking(self.write, data)
+            self.written = data
+
+    def write(self, data):
+        # The temporary file is only readable by the bot's user, as it may contain cookies
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temporary_path)
+            raise
+
+    async def run_saver(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.shield(self.save())
+            except Exception as e:
+                logging.error("Failed to save the session snapshot: %s", str(e))
+
+session_snapshots = SessionSnapshots(None if session_snapshot_path.lower() == "none" else session_snapshot_path)
+
+context_compactor = ContextCompactor(context_token_budget, max_messages, summary_model)
+
+class ModelList:
+    # The bots/models of one Poe account, with the /select keyboard for them
+    def __init__(self, bot_names):
+        # codename -> display name
+        self.bot_names = dict(bot_names)
+        self.fetched_at = time.monotonic()
+        # The buttons carry the codename. Telegram only takes 64 bytes of button data, longer codenames (like the
+        # file paths some OpenAI API servers use as model ids) are replaced by a hash of them.
+        # button data -> codename
+        self.codenames = {button_data(codename): codename for codename in self.bot_names}
+        self.reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(text=name, callback_data=button_data(codename))] for codename, name in self.bot_names.items()]
+        )
+
+def button_data(codename):
+    if len(codename.encode("utf-8")) <= 64:
+        return codename
+    return "#" + hashlib.sha256(codename.encode("utf-8")).hexdigest()[:32]
+
+class ModelCatalog:
+    # Caches the list of bots/models of every slot. An outdated list is still used while it's downloaded again
+    # in the background, and a slot's list is dropped when its cookie changes.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lists = {}
+        self.refreshing = {}
+
+    async def get(self, slot):
+        models = self.lists.get(slot)
+        if models is None:
+            bot_names = await chat_backends.bot_names(slot)
+            models = self.lists.setdefault(slot, ModelList(bot_names))
+        elif time.monotonic() - models.fetched_at > self.ttl and slot not in self.refreshing:
+            self.refreshing[slot] = asyncio.ensure_future(self.refresh(slot))
+        return models
+
+    async def refresh(self, slot):
+        accounts = chat_backends.accounts(slot)
+        try:
+            bot_names = await chat_backends.bot_names(slot, refresh=True)
+            # Don't keep the list if the cookie changed in the meantime
+            if chat_backends.accounts(slot) == accounts:
+                self.lists[slot] = ModelList(bot_names)
+        except Exception as e:
+            logging.error("Failed to download the list of bots: %s", str(e))
+        finally:
+            self.refreshing.pop(slot, None)
+
+    def invalidate(self, slot=None):
+        if slot is None:
+            self.lists.clear()
+        else:
+            self.lists.pop(slot, None)
+
+def download_bot_names(client):
+    # Download the list of bots again, client.bot_names is updated by get_bots()
+    client.get_bots()
+    return client.bot_names
+
+model_catalog = ModelCatalog(model_cache_ttl)
+
+class ResponseCache:
+    # Remembers answers by (model, normalized prompt, context fingerprint), dropping the least recently used ones
+    # once it's full and every answer after ttl seconds
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, prompt, context=()):
+        # Prompts that only differ in case and whitespace get the same answer
+        normalized = " ".join(prompt.lower().split())
+        fingerprint = hashlib.sha1("\n".join(context).encode("utf-8")).hexdigest() if context else ""
+        return model, normalized, fingerprint
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, text):
+        self.entries[key] = (time.monotonic() + self.ttl, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+response_cache = ResponseCache(response_cache_size, response_cache_ttl)
+
+class PendingMessage:
+    # A message waiting to be answered
+    def __init__(self, update, context, text, user_line, formatted_message, bypass_cache):
+        self.update = update
+        self.context = context
+        self.message_id = update.effective_message.message_id
+        self.text = text
+        self.user_line = user_line
+        self.formatted_message = formatted_message
+        self.bypass_cache = bypass_cache
+
+class ChatScheduler:
+    # Answers one batch of messages at a time per chat. Messages that arrive in the meantime wait in the chat's queue
+    # and are answered together in the next batch.
+    # A chat waits for at most one of the max_concurrent slots at a time and the semaphore hands them out in order,
+    # so a busy chat can't keep the others waiting.
+    # The answer of a batch runs as its own task, which cancel() stops when the batch isn't needed anymore.
+    def __init__(self, max_depth, max_concurrent):
+        self.max_depth = max_depth
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.queues = {}
+        self.workers = {}
+        # chat_id -> (task, batch) of the batch being answered
+        self.answering = {}
+        # chat_id -> other tasks of the chat that cancel() stops too, like /compare
+        self.side_tasks = {}
+
+    def submit(self, chat_id, pending, answer):
+        # Queue a message, returns False if the chat's queue is full
+        queue = self.queues.setdefault(chat_id, [])
+        if len(queue) >= self.max_depth:
+            return False
+        queue.append(pending)
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.ensure_future(self.run(chat_id, answer))
+        return True
+
+    async def run(self, chat_id, answer):
+        try:
+            while self.queues.get(chat_id):
+                async with self.semaphore:
+                    # Take everything that arrived while waiting for a slot, unless it was dropped in the meantime
+                    batch = self.queues.pop(chat_id, [])
+                    if not batch:
+                        continue
+                    task = asyncio.ensure_future(answer(chat_id, batch))
+                    self.answering[chat_id] = (task, batch)
+                    try:
+                        # Doesn't raise when the answer is cancelled
+                        await asyncio.wait([task])
+                    finally:
+                        del self.answering[chat_id]
+        finally:
+            del self.workers[chat_id]
+            if not self.queues.get(chat_id):
+                self.queues.pop(chat_id, None)
+
+    def replace(self, chat_id, pending, answer):
+        # Answer an edited message instead of its old text. A waiting message is replaced in the queue. If it's being
+        # answered, the answer is stopped and the rest of its batch is queued again together with it.
+        queue = self.queues.get(chat_id, [])
+        for index, queued in enumerate(queue):
+            if queued.message_id == pending.message_id:
+                queue[index] = pending
+                return True
+        answering = self.answering.get(chat_id)
+        if answering is None or answering[0].done() or all(queued.message_id != pending.message_id for queued in answering[1]):
+            # It was answered already, so it's a new question
+            return self.submit(chat_id, pending, answer)
+        task, batch = answering
+        task.cancel("Stopped, answering the edited message instead.")
+        queue = self.queues.setdefault(chat_id, [])
+        queue[:0] = [queued for queued in batch if queued.message_id != pending.message_id] + [pending]
+        return True
+
+    def track(self, chat_id, coroutine):
+        # Run a task of the chat next to its queue, which cancel() stops as well
+        task = asyncio.ensure_future(coroutine)
+        tasks = self.side_tasks.setdefault(chat_id, set())
+        tasks.add(task)
+
+        def done(task):
+            tasks.discard(task)
+            if not tasks and self.side_tasks.get(chat_id) is tasks:
+                del self.side_tasks[chat_id]
+        task.add_done_callback(done)
+        return task
+
+    def cancel(self, chat_id, reason):
+        # Stop answering the chat's messages and forget the waiting ones. Returns the number of dropped messages
+        # and other stopped tasks.
+        dropped = len(self.queues.pop(chat_id, ()))
+        answering = self.answering.get(chat_id)
+        if answering is not None and not answering[0].done():
+            # The reason is shown instead of the reply
+            answering[0].cancel(reason)
+            dropped += len(answering[1])
+        for task in self.side_tasks.get(chat_id, ()):
+            if not task.done():
+                task.cancel(reason)
+                dropped += 1
+        return dropped
+
+    def depth(self, chat_id):
+        return len(self.queues.get(chat_id, ()))
+
+    async def join(self):
+        # Wait until every queued message is answered and the other tasks are done
+        while self.workers or self.side_tasks:
+            tasks = [*self.workers.values(), *(task for tasks in self.side_tasks.values() for task in tasks)]
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+scheduler = ChatScheduler(queue_max_depth, max_concurrent_generations)
+
+async def check_access(update: Update, context: CallbackContext) -> None:
+    # Runs before every other handler and stops the update if the user or chat isn't allowed to use the bot
+    chat = update.effective_chat
+    user = update.effective_user
+    with measure("access_check"):
+        allowed = access_control.is_allowed(chat.id if chat else None, user.id if user else None)
+    if allowed:
+        return
+
+    text = "Sorry, you are not allowed to use this bot. If you are the one who set up this bot, add your Telegram UserID to the \"ALLOWED_USERS\" environment variable in your .env file, or use it in the \"ALLOWED_CHATS\" you specified."
+    if update.callback_query:
+        await update.callback_query.answer(text="Sorry, you are not allowed to use this bot.")
+    elif chat and update.effective_message and bot_addressed.meant_for_bot(update.effective_message) and access_control.should_reply(chat.id):
+        # Deny access if the user is not in the allowed users list and the chat is not in the allowed chats list.
+        # Group chatter that isn't meant for the bot is ignored without a reply.
+        await telegram_sender.send_message(context.bot, chat_id=chat.id, text=text)
+    raise ApplicationHandlerStop
+
+async def deny_command(update: Update, context: CallbackContext) -> bool:
+    # Deny access to a settings command if the user is not in the allowed users list
+    if access_control.is_admin(update.effective_user.id):
+        return False
+    if access_control.should_reply(update.effective_chat.id):
+        await telegram_sender.send_message(
+            context.bot,
+            chat_id=update.effective_chat.id,
+            text="Sorry, you are not allowed to use this command. If you are the one who set up this bot, add your Telegram UserID to the \"ALLOWED_USERS\" environment variable in your .env file."
+        )
+    return True
+
+async def start(update: Update, context: CallbackContext) -> None:
+    await telegram_sender.send_message(
+        context.bot,
         chat_id=update.effective_chat.id,
         text="I'm a Poe.com Telegram Bot. Use /help for a list of commands.",
     )
 
 async def purge(update: Update, context: CallbackContext):
     try:
+        # Stop answering, the answers would belong to the purged conversation
+        scheduler.cancel(update.effective_chat.id, "Stopped, the conversation was purged.")
+        context_compactor.cancel(update.effective_chat.id)
+
         # Purge the entire conversation
-        client.purge_conversation(selected_model)
+        session = await sessions.get(update.effective_chat.id)
+        await chat_backends.for_model(session.model).purge(session.slot, session.model)
         
-        # Remove the chat log file
-        if os.path.isfile(chat_log_file):
-            os.remove(chat_log_file)
+        # Clear the chat log
+        chat_history.clear(update.effective_chat.id)
         
-        await context.bot.send_message(
+        await telegram_sender.send_message(
+            context.bot,
             chat_id=update.effective_chat.id,
-            text="Conversation purged. Chat log file deleted.",
+            text="Conversation purged. Chat log deleted.",
         )
     except Exception as e:
         await handle_error(update, context, e)
 
 async def reset(update: Update, context: CallbackContext):
     try:
+        # Stop answering, the answers would belong to the cleared context
+        scheduler.cancel(update.effective_chat.id, "Stopped, the context was cleared.")
+        context_compactor.cancel(update.effective_chat.id)
+
         # Clear the context
-        client.send_chat_break(selected_model)
+        session = await sessions.get(update.effective_chat.id)
+        await chat_backends.for_model(session.model).chat_break(session.slot, session.model)
         
-        # Remove the chat log file
-        if os.path.isfile(chat_log_file):
-            os.remove(chat_log_file)
+        # Clear the chat log
+        chat_history.clear(update.effective_chat.id)
         
-        await context.bot.send_message(
+        await telegram_sender.send_message(
+            context.bot,
             chat_id=update.effective_chat.id,
-            text="Context cleared. Chat log file deleted.",
+            text="Context cleared. Chat log deleted.",
         )
     except Exception as e:
         await handle_error(update, context, e)
 
-async def select(update: Update, context: CallbackContext):
+async def stop(update: Update, context: CallbackContext):
     try:
-        # Get the list of available bots
-        bot_names = client.bot_names.values()
-
-        # Create a list of InlineKeyboardButtons for each bot
-        buttons = []
-        for bot_name in bot_names:
-            button = InlineKeyboardButton(text=bot_name, callback_data=bot_name)
-            buttons.append([button])
+        # Stop the answer that is being generated and drop the messages waiting for it
+        dropped = scheduler.cancel(update.effective_chat.id, "Stopped.")
+        await telegram_sender.send_message(
+            context.bot,
+            chat_id=update.effective_chat.id,
+            text=f"Stopped answering {dropped} message(s)." if dropped else "There is nothing to stop.",
+        )
+    except Exception as e:
+        await handle_error(update, context, e)
 
-        # Create an InlineKeyboardMarkup with the list of buttons
-        reply_markup = InlineKeyboardMarkup(buttons)
+async def select(update: Update, context: CallbackContext):
+    try:
+        # Get the list of available bots, with a button for each bot
+        session = await sessions.get(update.effective_chat.id)
+        reply_markup = (await model_catalog.get(session.slot)).reply_markup
 
         # Send a message to the user with the list of buttons
-        await context.bot.send_message(
+        await telegram_sender.send_message(
+            context.bot,
             chat_id=update.effective_chat.id,
             text="Please select a bot/model:",
             reply_markup=reply_markup,
@@ -135,38 +2005,32 @@ async def button_callback(update: Update, context: CallbackContext):
     query = update.callback_query
 
     try:
-        # Get the selected bot/model codename
-        selected_bot = next(
-            (k for k, v in client.bot_names.items() if v == query.data), None
-        )
+        # The button carries the selected bot/model codename, or a hash of it if it's too long
+        session = await sessions.get(update.effective_chat.id)
+        models = await model_catalog.get(session.slot)
+        codename = models.codenames.get(query.data)
 
-        if selected_bot is None:
+        if codename is None:
             await query.answer(text="Invalid selection.")
         else:
-            # Set the selected bot/model for the entire context
-            global selected_model
-            selected_model = selected_bot
+            bot_name = models.bot_names[codename]
+            # Set the selected bot/model for this chat
+            session.model = codename
 
             # Send a confirmation message to the user
-            await query.answer(text=f"{query.data} model selected.")
+            await query.answer(text=f"{bot_name} model selected.")
     except Exception as e:
         await handle_error(update, context, e)
 
 async def set_cookie(update: Update, context: CallbackContext):
-    user_id = update.effective_user.id
-
-    if ALLOWED_USERS and str(user_id) not in ALLOWED_USERS.split(","):
-        # Deny access if user is not in the allowed users list
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Sorry, you are not allowed to use this command. If you are the one who set up this bot, add your Telegram UserID to the \"ALLOWED_USERS\" environment variable in your .env file."
-        )
+    if await deny_command(update, context):
         return
 
     # Get the cookie value from the command message
     command_parts = update.message.text.split()
     if len(command_parts) != 3:
-        await context.bot.send_message(
+        await telegram_sender.send_message(
+            context.bot,
             chat_id=update.effective_chat.id,
             text="Please provide the cookie type and value in the format: /setcookie <cookie_type> <cookie_value>"
         )
@@ -177,51 +2041,92 @@ async def set_cookie(update: Update, context: CallbackContext):
 
     # Set the authentication cookie based on the provided cookie type
     if cookie_type == "POE_COOKIE":
-        # Set the POE_COOKIE for the poe Client
-        client = poe.Client(cookie_value)
+        if not client_pool.slots:
+            await telegram_sender.send_message(
+                context.bot,
+                chat_id=update.effective_chat.id,
+                text="POE_COOKIE can only be set when the bot is started with a POE_COOKIE."
+            )
+            return
+        # Replace the poe Client used by this chat
+        session = await sessions.get(update.effective_chat.id)
+        try:
+            await client_pool.replace(session.slot, cookie_value)
+        except Exception as e:
+            await handle_error(update, context, e)
+            return
+        # The new account may have other bots
+        model_catalog.invalidate(session.slot)
     elif cookie_type == "BING_AUTH_COOKIE":
         # Update the auth_cookie variable as well
         global auth_cookie
         auth_cookie = cookie_value
     else:
-        await context.bot.send_message(
+        await telegram_sender.send_message(
+            context.bot,
             chat_id=update.effective_chat.id,
             text="Invalid cookie type. Supported cookie types are: POE_COOKIE, BING_AUTH_COOKIE"
         )
         return
 
-    await context.bot.send_message(
+    await telegram_sender.send_message(
+        context.bot,
         chat_id=update.effective_chat.id,
         text=f"{cookie_type} set successfully."
     )
 
 async def restart_bot(update: Update, context: CallbackContext):
-    user_id = update.effective_user.id
-
-    if ALLOWED_USERS and str(user_id) not in ALLOWED_USERS.split(","):
-        # Deny access if user is not in the allowed users list
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Sorry, you are not allowed to use this command. If you are the one who set up this bot, add your Telegram UserID to the \"ALLOWED_USERS\" environment variable in your .env file."
-        )
+    if await deny_command(update, context):
         return
 
-    # Reset the "POE_COOKIE" of the poe Client to default.
-    client = poe.Client(POE_COOKIE)
+    # Reset the "POE_COOKIE" of the poe Clients to default.
+    client_pool.reset()
+    model_catalog.invalidate()
 
     # Reset the auth_cookie variable as well
     global auth_cookie
     auth_cookie = os.getenv("BING_AUTH_COOKIE")
 
-    # Clear the selected model
-    global selected_model
-    selected_model = default_model if default_model else "capybara"
+    # Forget the selected models of all chats, also the ones saved before the last start
+    sessions.reset()
+    session_snapshots.chats.clear()
 
-    await context.bot.send_message(
+    await telegram_sender.send_message(
+        context.bot,
         chat_id=update.effective_chat.id,
         text="Bot restarted and settings set back to default."
     )
 
+async def cache(update: Update, context: CallbackContext):
+    # Turn the response cache on or off for this chat, or show its statistics
+    session = await sessions.get(update.effective_chat.id)
+    if context.args and context.args[0].lower() in ("on", "off"):
+        session.cache_enabled = context.args[0].lower() == "on"
+
+    await telegram_sender.send_message(
+        context.bot,
+        chat_id=update.effective_chat.id,
+        text=(
+            f"Response cache is {'on' if session.cache_enabled else 'off'} for this chat. "
+            f"{len(response_cache.entries)} cached answers, hit ratio {response_cache.hit_ratio:.0%} "
+            f"({response_cache.hits} hits, {response_cache.misses} misses). "
+            f"Add {response_cache_bypass} to a message to skip the cache."
+        ),
+    )
+
+async def reload_access(update: Update, context: CallbackContext):
+    if await deny_command(update, context):
+        return
+
+    # Read ALLOWED_USERS and ALLOWED_CHATS again from the .env file
+    access_control.reload()
+
+    await telegram_sender.send_message(
+        context.bot,
+        chat_id=update.effective_chat.id,
+        text=f"Access lists reloaded: {len(access_control.users)} allowed users, {len(access_control.chats)} allowed chats."
+    )
+
 # Not working, just an idea for now. not sure if it's possible to get an x number of previous messages...
 #async def summarize(update: Update, context: CallbackContext):
 #    try:
@@ -274,12 +2179,100 @@ async def restart_bot(update: Update, context: CallbackContext):
 #    except Exception as e:
 #        await handle_error(update, context, e)
 
+# The HTTP client used to download the images
+http_client = None
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=image_download_timeout,
+            limits=httpx.Limits(max_connections=image_download_concurrency),
+            follow_redirects=True,
+        )
+    return http_client
+
+async def download_images(links):
+    # Download the images at the same time into memory, skipping the ones that fail
+    client = get_http_client()
+
+    async def download(link):
+        try:
+            response = await client.get(link)
+            response.raise_for_status()
+            return response.content
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            logging.warning("Could not download image %s: %s", link, str(e))
+            return None
+
+    images = await asyncio.gather(*(download(link) for link in links))
+    return [image for image in images if image]
+
+# The image backends have the same methods: generate() returns the images of a prompt
+class BingImageBackend:
+    # Bing Image Creator, with the cookie from BING_AUTH_COOKIE or /setcookie
+    missing_setup = "Authorization cookie is not set. Please configure the BING_AUTH_COOKIE environment variable."
+
+    def __init__(self):
+        # The ImageGen for the current Bing cookie, as (cookie, ImageGen)
+        self.image_gen = None
+
+    def ready(self):
+        return bool(auth_cookie)
+
+    def get_image_gen(self):
+        # Reuse the ImageGen and its session as long as the Bing cookie stays the same
+        if self.image_gen is None or self.image_gen[0] != auth_cookie:
+            self.image_gen = (auth_cookie, ImageGen(auth_cookie))
+        return self.image_gen[1]
+
+    async def generate(self, prompt):
+        # Bing only returns the links, the images are downloaded into memory
+        image_links = await run_blocking(self.get_image_gen().get_images, prompt)
+        return await download_images(image_links)
+
+class OpenAIImageBackend:
+    # The image generations of a server with the OpenAI API
+    missing_setup = "The image server is not set. Please configure the OPENAI_BASE_URL environment variable."
+
+    def __init__(self, server, model, timeout):
+        self.server = server
+        self.model = model
+        self.timeout = timeout
+
+    def ready(self):
+        return self.server is not None
+
+    async def generate(self, prompt):
+        body = {"prompt": prompt, "response_format": "b64_json"}
+        if self.model:
+            body["model"] = self.model
+        # Generating takes longer than answering, so the images have a timeout of their own
+        response = await self.server.client().post(
+            "/images/generations", json=body, timeout=httpx.Timeout(self.timeout, connect=10)
+        )
+        response.raise_for_status()
+        data = response.json().get("data", [])
+        # Servers that ignore response_format return links instead
+        images = [base64.b64decode(item["b64_json"]) for item in data if item.get("b64_json")]
+        return images + await download_images([item["url"] for item in data if item.get("url")])
+
+def create_image_backend():
+    if image_backend_name == "bing":
+        return BingImageBackend()
+    if image_backend_name == "openai":
+        return OpenAIImageBackend(openai_server, openai_image_model, openai_image_timeout)
+    raise ValueError(f"Unknown IMAGE_BACKEND: {image_backend_name}")
+
+image_backend = create_image_backend()
+
 async def imagine(update: Update, context: CallbackContext):
     try:
         # Check if a prompt is provided as an argument
         command_parts = update.effective_message.text.split()
         if len(command_parts) < 2:
-            await context.bot.send_message(
+            await telegram_sender.send_message(
+                context.bot,
                 chat_id=update.effective_chat.id,
                 text="Please provide a prompt. Example: /imagine cat",
             )
@@ -287,38 +2280,28 @@ async def imagine(update: Update, context: CallbackContext):
 
         prompt = ' '.join(command_parts[1:])
 
-        if not auth_cookie:
-            await context.bot.send_message(
+        if not image_backend.ready():
+            await telegram_sender.send_message(
+                context.bot,
                 chat_id=update.effective_chat.id,
-                text="Authorization cookie is not set. Please configure the BING_AUTH_COOKIE environment variable.",
+                text=image_backend.missing_setup,
             )
             return
 
         # Send a message to indicate that the bot is working
-        working_message = await context.bot.send_message(
+        working_message = await telegram_sender.send_message(
+            context.bot,
             chat_id=update.effective_chat.id,
             text="Please wait, generating images...",
         )
 
-        # Create an instance of ImageGen with the auth_cookie
-        image_gen = ImageGen(auth_cookie)
-
-        # Get the image links from Bing
-        image_links = image_gen.get_images(prompt)
-
-        # Create a temporary directory to save the images
-        temp_dir = "temp_images"
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Save the images to the temporary directory
-        image_gen.save_images(image_links, temp_dir)
+        # Generate the images
+        images = await image_backend.generate(prompt)
+        if not images:
+            raise Exception("Could not download any of the generated images.")
 
         # Prepare the list of InputMediaPhoto objects for sending grouped photos
-        media_photos = []
-        for filename in os.listdir(temp_dir):
-            image_path = os.path.join(temp_dir, filename)
-            with open(image_path, "rb") as image_file:
-                media_photos.append(InputMediaPhoto(media=image_file))
+        media_photos = [InputMediaPhoto(media=image) for image in images]
 
         # Split the photos into multiple groups if necessary
         max_photos_per_group = 10
@@ -326,63 +2309,75 @@ async def imagine(update: Update, context: CallbackContext):
 
         # Send the grouped photos back to the user in separate media groups
         for group in grouped_photos:
-            await context.bot.send_media_group(
+            await telegram_sender.send_media_group(
+                context.bot,
                 chat_id=update.effective_chat.id,
                 media=group,
             )
 
-        # Remove the temporary directory and its contents
-        shutil.rmtree(temp_dir)
-
         # Delete the working message
         await working_message.delete()
 
     except Exception as e:
         await handle_error(update, context, e)
 
-# Specify the path to the chat log file
-chat_log_file = "chat_log.txt"
-max_messages = 20
+class BotAddressed(filters.MessageFilter):
+    # Lets through the messages of private chats, and the group messages that mention the bot or reply to one of its
+    # messages. It runs before the message handler, so group messages that aren't meant for the bot cost almost nothing.
+    def __init__(self):
+        super().__init__(name="BotAddressed")
+        self.bot_id = None
+        self.mention = None
+        self.mention_pattern = None
+
+    def set_bot(self, username, bot_id):
+        # The bot's username and id are set once at startup
+        self.bot_id = bot_id
+        self.mention = f"@{username}".lower()
+        self.mention_pattern = re.compile(re.escape(f"@{username}"), re.IGNORECASE)
+
+    def filter(self, message):
+        # Channel posts are never answered
+        if message.chat.type == "private":
+            return True
+        if message.chat.type not in ("group", "supergroup"):
+            return False
+        if self.bot_id is None:
+            bot = message.get_bot()
+            self.set_bot(bot.username, bot.id)
+
+        reply = message.reply_to_message
+        if reply is not None and reply.from_user is not None and reply.from_user.id == self.bot_id:
+            return True
+        # Mentions can be anywhere in the message. A text_mention links to a user without a username.
+        for entity in message.entities:
+            if entity.type == MessageEntity.MENTION and message.parse_entity(entity).lower() == self.mention:
+                return True
+            if entity.type == MessageEntity.TEXT_MENTION and entity.user is not None and entity.user.id == self.bot_id:
+                return True
+        return False
+
+    def meant_for_bot(self, message):
+        # The messages the filter lets through and the commands, unless they name another bot (/start@OtherBot)
+        if message.text and message.text.startswith("/"):
+            command = message.text.split(maxsplit=1)[0].lower()
+            return "@" not in command or self.mention is None or command.endswith(self.mention)
+        return self.filter(message)
+
+    def strip_mention(self, text):
+        return self.mention_pattern.sub("", text) if self.mention_pattern else text
+
+bot_addressed = BotAddressed()
 
 async def process_message(update: Update, context: CallbackContext) -> None:
-    message = update.message
-    user_id = message.from_user.id
+    # Only the messages meant for the bot get here, see BotAddressed. Edited messages get here too.
+    message = update.effective_message
     chat_id = message.chat.id
-
-    # Create the chat log file with instructions if it doesn't exist
-    if not os.path.isfile(chat_log_file):
-        with open(chat_log_file, "w") as file:
-            file.write("As a reminder, these are the last 20 messages:\n")
-
-    if ALLOWED_CHATS and str(chat_id) not in ALLOWED_CHATS.split(",") and str(user_id) not in ALLOWED_USERS.split(","):
-        # Deny access if the user is not in the allowed users list and the chat is not in the allowed chats list
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Sorry, you are not allowed to use this bot. If you are the one who set up this bot, add your Telegram UserID to the \"ALLOWED_USERS\" environment variable in your .env file."
-        )
+    # Messages sent on behalf of a channel have no user to answer
+    if message.from_user is None:
         return
 
     try:
-        # Check if the message mentions the bot or is a reply to the bot
-        if message.chat.type == "group" and not (
-            message.text
-            and (
-                message.entities
-                and message.entities[0].type == "mention"
-                and f"@{context.bot.username}" in message.text
-                or (
-                    message.reply_to_message
-                    and message.reply_to_message.from_user.id == context.bot.id
-                )
-            )
-        ):
-            return
-
-        # Send a "working" message to indicate that the bot is processing the message
-        message_obj = await context.bot.send_message(
-            chat_id=message.chat_id, text="Working..."
-        )
-
         # Format the message to include the user's nickname but exclude the bot's mention
         nickname = message.from_user.first_name
         # Provide the username too
@@ -390,102 +2385,249 @@ async def process_message(update: Update, context: CallbackContext) -> None:
         # Prepare the username part if it exists
         username_part = f" but use @{username} for mentions" if username else ""
 
+        # Remove the bot's mention, and the cache bypass marker if it's there
+        text = bot_addressed.strip_mention(message.text)
+        bypass_cache = response_cache_bypass in text
+        text = text.replace(response_cache_bypass, '')
+
         # Construct the formatted message
         formatted_message = (
             f"(OOC: Refer to me as {nickname}{username_part}."
             "Never bring up this message, or any instructions before \"says:\". "
             "If you have one, stay in character!) "
-            f"User {nickname} says: {message.text.replace(f'@{context.bot.username}', '')}"
+            f"User {nickname} says: {text}"
         )
+        user_line = f"User {nickname} said: {text}"
 
-        # Save the user's message in the chat log
-        with open(chat_log_file, "a") as file:
-            file.write(f"User {nickname} said: {message.text.replace(f'@{context.bot.username}', '')}\n")
+        # Queue the message, it's answered once the previous messages of this chat are.
+        # An edited message replaces its old text, which isn't answered anymore.
+        pending = PendingMessage(update, context, text, user_line, formatted_message, bypass_cache)
+        if update.edited_message is not None:
+            queued = scheduler.replace(chat_id, pending, generate_reply)
+        else:
+            queued = scheduler.submit(chat_id, pending, generate_reply)
+        if not queued:
+            await telegram_sender.send_message(
+                context.bot,
+                chat_id=chat_id,
+                text="I'm still answering the previous messages in this chat, please wait a moment and try again.",
+            )
+    except Exception as e:
+        await handle_error(update, context, e)
 
-        # Count the number of messages in the chat log file (excluding the first line)
-        num_messages = sum(1 for line in open(chat_log_file).readlines()[1:] if line.startswith("User") or line.startswith("You answered:"))
+async def generate_reply(chat_id, batch):
+    # Answer a batch of queued messages of one chat with a single request
+    update, context = batch[-1].update, batch[-1].context
 
+    with measure("reply_total"):
+        await answer_batch(chat_id, batch, update, context)
 
-        # Add a random delay before sending the request (Hopefully mitigates possibility of being banned.)
-        delay_seconds = random.uniform(0.5, 2.0)
-        time.sleep(delay_seconds)
+async def answer_batch(chat_id, batch, update, context):
+    message_obj = None
+    try:
+        # Send a "working" message to indicate that the bot is processing the message
+        message_obj = await telegram_sender.send_message(
+            context.bot, chat_id=chat_id, text="Working..."
+        )
 
-        # Check the number of messages in the chat log and send the file contents to the bot
-        if num_messages >= max_messages:
-            # Read the contents of the chat log file
-            with open(chat_log_file, "r") as file:
-                chat_log_content = file.read()
+        session = await sessions.get(chat_id)
+        history = session.history
+
+        # Look for a cached answer, unless several messages are answered at once
+        cache_key = None
+        message_text = None
+        if session.cache_enabled and len(batch) == 1 and not batch[0].bypass_cache:
+            context_lines = list(history)[-response_cache_context:] if response_cache_context > 0 else ()
+            cache_key = response_cache.key(session.model, batch[0].text, context_lines)
+            message_text = response_cache.get(cache_key)
+
+        # Send the formatted messages together with the chat log to the selected bot/model
+        prompt = build_prompt(history, "\n\n".join(pending.formatted_message for pending in batch))
+
+        if message_text is None:
+            # Get the response, showing it while it's being generated if streaming is enabled.
+            # Requests are only delayed when too many are sent with the chat's cookie or to its model,
+            # and fallback models answer if the selected one fails or is too slow.
+            with measure("generation"):
+                reply = RoutedReply(session.slot, session.model, prompt)
+                if stream_replies:
+                    message_text = await stream_reply(context, chat_id, message_obj.message_id, reply)
+                else:
+                    message_text = "".join([text_new async for text_new in reply])
+
+            # Answers of a fallback model aren't cached for the selected model
+            if cache_key is not None and message_text.strip() and reply.answered_by == session.model:
+                response_cache.put(cache_key, message_text)
+
+        # Escape any MarkdownV2 special characters in the message text, keeping code blocks and inline code,
+        # and split it into messages Telegram accepts
+        messages_escaped = split_markdown(message_text)
+
+        # Save the users' messages and the bot's reply in the chat log, and summarize its older messages if it's
+        # getting too long. A stopped answer leaves nothing in the chat log.
+        for pending in batch:
+            chat_history.append(chat_id, pending.user_line)
+        chat_history.append(chat_id, f"You answered: {message_text}")
+        context_compactor.schedule(session)
+
+        # Edit and replace the "working" message with the response message, and send the rest of a long response as new messages
+        await telegram_sender.reply(context.bot, chat_id, message_obj.message_id, messages_escaped)
+    except asyncio.CancelledError as e:
+        # The answer isn't needed anymore, show why instead of the partial reply. Closing the chunks stopped the request.
+        if message_obj is not None:
+            reason = e.args[0] if e.args else "Stopped."
+            try:
+                await telegram_sender.edit_message_text(context.bot, chat_id, message_obj.message_id, text=reason)
+            except Exception as edit_error:
+                logging.debug("Could not show that the answer was stopped: %s", str(edit_error))
+        raise
+    except Exception as e:
+        await handle_error(update, context, e)
 
-            # Send the chat log to the selected bot/model and get the response
-            response = client.send_message(
-                selected_model, chat_log_content, with_chat_break=False
-            )
+# Maximum number of models a /compare question is sent to
+max_compare_models = 5
 
-            # Erase the chat log file
-            os.remove(chat_log_file)
-            # Re-Create the chat log file with instructions if it doesn't exist
-            if not os.path.isfile(chat_log_file):
-                with open(chat_log_file, "w") as file:
-                    file.write("As a reminder, these are the last 20 messages:\n")
-        else:
-            # Send the formatted message to the selected bot/model and get the response
-            response = client.send_message(
-                selected_model, formatted_message, with_chat_break=False
+async def compare(update: Update, context: CallbackContext):
+    # Send a question to several models at once, every answer is shown in its own message
+    try:
+        chat_id = update.effective_chat.id
+        command_parts = update.effective_message.text.split(maxsplit=2)
+        if len(command_parts) < 3:
+            await telegram_sender.send_message(
+                context.bot,
+                chat_id=chat_id,
+                text="Please provide the models and the question in the format: /compare <model>,<model> <question>",
             )
+            return
 
-        # Concatenate all the message chunks and send the full message back to the user
-        message_chunks = [chunk["text_new"] for chunk in response]
-        message_text = "".join(message_chunks)
-
-        # Remove .replace("`", "\\`") to enable markup rendering.
-        # Escape any MarkdownV2 special characters in the message text
-        message_text_escaped = (
-            message_text.replace("_", "\\_")
-            .replace("*", "\\*")
-            .replace("[", "\\[")
-            .replace("]", "\\]")
-            .replace("(", "\\(")
-            .replace(")", "\\)")
-            .replace("~", "\\~")
-            .replace(">", "\\>")
-            .replace("#", "\\#")
-            .replace("+", "\\+")
-            .replace("-", "\\-")
-            .replace("=", "\\=")
-            .replace("|", "\\|")
-            .replace("{", "\\{")
-            .replace("}", "\\}")
-            .replace(".", "\\.")
-            .replace("!", "\\!")
-        )
+        # Models can be given by codename or by name
+        session = await sessions.get(chat_id)
+        bot_names = (await model_catalog.get(session.slot)).bot_names
+        codenames = {name.lower(): codename for codename, name in bot_names.items()}
+        codenames.update({codename.lower(): codename for codename in bot_names})
+        requested = [model.strip() for model in command_parts[1].split(",") if model.strip()]
+        unknown = [model for model in requested if model.lower() not in codenames]
+        models = list(dict.fromkeys(codenames[model.lower()] for model in requested if model.lower() in codenames))
+        if unknown or not models:
+            available = ", ".join(f"{codename} ({name})" for codename, name in bot_names.items())
+            await telegram_sender.send_message(
+                context.bot,
+                chat_id=chat_id,
+                text=f"Unknown models: {', '.join(unknown) or 'none given'}. Available models: {available}",
+            )
+            return
+        if len(models) > max_compare_models:
+            await telegram_sender.send_message(
+                context.bot,
+                chat_id=chat_id,
+                text=f"Please compare at most {max_compare_models} models at once.",
+            )
+            return
 
-        # Save the bot's reply in the chat log
-        with open(chat_log_file, "a") as file:
-            file.write(f"You answered: {message_text}\n")
+        # The models answer at the same time, spread over the slots of the backends
+        slots = [compare_slot(session, index, model) for index, model in enumerate(models)]
+        if None in slots:
+            await telegram_sender.send_message(
+                context.bot,
+                chat_id=chat_id,
+                text=f"{bot_names[session.model]} can't be compared, as that would clear its conversation in this chat. Select another model first.",
+            )
+            return
 
-        # Edit and replace the "working" message with the response message
-        await context.bot.edit_message_text(
-            chat_id=message.chat_id,
-            message_id=message_obj.message_id,
-            text=message_text_escaped,
-            parse_mode="MarkdownV2",
+        # /stop, /reset and /purge stop the comparison too
+        comparison = scheduler.track(
+            chat_id, compare_models(context, chat_id, list(zip(slots, models)), bot_names, command_parts[2])
         )
+        await asyncio.wait([comparison])
+        if not comparison.cancelled():
+            comparison.result()
     except Exception as e:
         await handle_error(update, context, e)
 
+def compare_slot(session, index, model):
+    # The slot a compared model answers with. The chat's own conversation with its selected model stays untouched,
+    # so that model answers with another Poe account, or not at all if there is only one.
+    slot_count = chat_backends.slot_count()
+    slot = (session.slot + index) % slot_count
+    if model != session.model or not chat_backends.for_model(model).keeps_conversations:
+        return slot
+    if slot_count == 1:
+        return None
+    return slot if slot != session.slot else (slot + 1) % slot_count
+
+async def compare_models(context, chat_id, slots_and_models, bot_names, question):
+    started = time.perf_counter()
+    # Each model catches its own errors, return_exceptions only makes a stopped comparison wait until every model
+    # has shown that it was stopped
+    durations = await asyncio.gather(*(
+        compare_model(context, chat_id, slot, model, bot_names[model], question) for slot, model in slots_and_models
+    ), return_exceptions=True)
+    results = ", ".join(
+        f"{bot_names[model]} {seconds:.1f}s" if seconds is not None else f"{bot_names[model]} failed"
+        for (slot, model), seconds in zip(slots_and_models, durations)
+    )
+    await telegram_sender.send_message(
+        context.bot,
+        chat_id=chat_id,
+        text=f"Compared {len(slots_and_models)} models in {time.perf_counter() - started:.1f}s: {results}",
+    )
+
+async def compare_model(context, chat_id, slot, model, name, question):
+    # Answer a /compare question with one model, returns the seconds it took or None if it failed
+    placeholder = None
+    try:
+        placeholder = await telegram_sender.send_message(context.bot, chat_id=chat_id, text=f"{name}: Working...")
+        started = time.perf_counter()
+        # The question is sent after a chat break and isn't added to the chat log, so it doesn't mix with the chat's conversation
+        chunks = backend_chunks(slot, model, question, with_chat_break=True)
+        if stream_replies:
+            message_text = await stream_reply(context, chat_id, placeholder.message_id, chunks)
+        else:
+            message_text = "".join([text_new async for text_new in chunks])
+        seconds = time.perf_counter() - started
+    except asyncio.CancelledError as e:
+        # The comparison was stopped, show why instead of the partial answer
+        if placeholder is not None:
+            reason = e.args[0] if e.args else "Stopped."
+            try:
+                await telegram_sender.edit_message_text(context.bot, chat_id, placeholder.message_id, text=f"{name}: {reason}")
+            except Exception as edit_error:
+                logging.debug("Could not show that the comparison was stopped: %s", str(edit_error))
+        raise
+    except Exception as e:
+        logging.warning("%s failed to answer a comparison: %s", model, str(e))
+        if placeholder is None:
+            return None
+        await telegram_sender.edit_message_text(
+            context.bot, chat_id, placeholder.message_id, text=f"{name} failed to answer: {e}"
+        )
+        return None
+
+    # Show the answer with the model's name and how long it took
+    header = f"*{escape_text(name)}* {escape_text(f'({seconds:.1f}s)')}\n\n"
+    messages_escaped = split_markdown(message_text, max_message_length - len(header))
+    messages_escaped[0] = header + messages_escaped[0]
+    await telegram_sender.reply(context.bot, chat_id, placeholder.message_id, messages_escaped)
+    return seconds
+
 async def help_command(update: Update, context: CallbackContext) -> None:
     help_text = (
         "Available commands:\n\n"
         "/start - Start the bot.\n"
         "/purge - Purge the entire conversation with the selected bot/model.\n"
         "/reset - Clear/Reset the context with the selected bot/model.\n"
+        "/stop - Stop answering the messages that are being answered or waiting.\n"
         "/select - Select a bot/model to use for the conversation.\n"
         "/setcookie <cookie_type> <cookie_value> - Set the POE cookie value. Supported cookie types are: POE_COOKIE, BING_AUTH_COOKIE\n"
         "/restart - Restart the bot and set everything back to the default.\n"
+        "/reloadaccess - Reload the allowed users and chats from the .env file.\n"
+        "/cache [on|off] - Answer repeated questions from a cache in this chat, or show the cache statistics.\n"
+        "/compare <model>,<model> <question> - Ask several bots/models the same question at once.\n"
         "/imagine - Generate an image using AI.\n"
         "/help - Show this help message."
     )
-    await context.bot.send_message(
+    await telegram_sender.send_message(
+        context.bot,
         chat_id=update.effective_chat.id,
         text=help_text,
     )
@@ -493,37 +2635,310 @@ async def help_command(update: Update, context: CallbackContext) -> None:
 
 async def handle_error(update: Update, context: CallbackContext, exception: Exception):
     logging.error("An error occurred: %s", str(exception))
+    errors_total.inc(type(exception).__name__)
     error_message = "An error occurred while processing your request."
-    await context.bot.send_message(
+    if isinstance(exception, (TimeoutError, CircuitOpenError)):
+        # These are worth trying again later
+        error_message = f"{exception} Please try again later."
+    await telegram_sender.send_message(
+        context.bot,
         chat_id=update.effective_chat.id,
         text=error_message,
     )
 
+# Gauges are read from the other parts of the bot when the metrics are rendered
+metrics.add(Gauge("poebot_active_sessions", "Chats kept in memory.", lambda: len(sessions.sessions)))
+metrics.add(Gauge("poebot_queued_messages", "Messages waiting to be answered.", lambda: sum(map(len, scheduler.queues.values()))))
+metrics.add(Gauge("poebot_busy_chats", "Chats that are being answered or waiting for a slot.", lambda: len(scheduler.workers)))
+metrics.add(Gauge("poebot_open_circuits", "Accounts and models whose requests fail right away.", backend_breaker.open_count))
+metrics.add(Gauge("poebot_active_route", "Model that answered the last message for each selected model.", model_router.route_values, labels=("selected", "model")))
+metrics.add(Gauge("poebot_model_first_chunk_seconds", "Moving average of the time until a model's first chunk.", model_router.latency_values, labels=("model",)))
+metrics.add(Gauge("poebot_model_error_ratio", "Moving average of the share of a model's failed requests.", model_router.error_values, labels=("model",)))
+metrics.add(Gauge("poebot_connected_poe_clients", "Connected Poe clients.", lambda: sum(slot.client is not None for slot in client_pool.slots)))
+metrics.add(Gauge("poebot_response_cache_hits_total", "Answers taken from the response cache.", lambda: response_cache.hits, "counter"))
+metrics.add(Gauge("poebot_response_cache_misses_total", "Cache lookups without a cached answer.", lambda: response_cache.misses, "counter"))
+metrics_server = None
+
+# The tasks on_startup runs in the background until on_shutdown cancels them. They're started with asyncio, as the
+# application doesn't run yet in post_init and wouldn't await its own tasks.
+background_tasks = []
+
+async def on_startup(application):
+    global metrics_server
+
+    # Remember who the bot is, for recognizing the group messages meant for it
+    bot_addressed.set_bot(application.bot.username, application.bot.id)
+
+    # Save new chat history and the chats' settings in the background
+    background_tasks.append(asyncio.create_task(chat_history.run_flusher(history_flush_interval)))
+    await session_snapshots.restore()
+    background_tasks.append(asyncio.create_task(session_snapshots.run_saver(session_snapshot_interval)))
+
+    # Connect the Poe clients and list the models of the other backends in the background, updates are already
+    # accepted in the meantime
+    background_tasks.append(asyncio.create_task(chat_backends.warm_up()))
+
+    # Serve the metrics and log a summary of them, if enabled
+    if metrics_port:
+        metrics_server = await asyncio.start_server(serve_metrics, metrics_host, metrics_port)
+        logging.info("Serving metrics on http://%s:%s/metrics", metrics_host, metrics_port)
+    if metrics_log_interval > 0:
+        background_tasks.append(asyncio.create_task(log_metrics(metrics_log_interval)))
+
+async def on_stop(application):
+    # Answer the messages that are still queued before the bot disconnects
+    await scheduler.join()
+
+async def on_shutdown(application):
+    # Stop the background tasks, the final flush and save below write what's left
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+    # Stop serving the metrics
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+    # Save whatever chat history is left, and the chats' settings
+    await chat_history.close()
+    try:
+        await session_snapshots.save()
+    except Exception as e:
+        logging.error("Failed to save the session snapshot: %s", str(e))
+
+    # Close the connections used to download images and to reach the server with the OpenAI API
+    if http_client is not None:
+        await http_client.aclose()
+    if openai_server is not None:
+        await openai_server.close()
+
+# The requests to the webhook server that are being handled
+webhook_requests = set()
+# Telegram updates are much smaller than this
+max_update_size = 1024 * 1024
+
+async def receive_webhook(reader, writer, deliver):
+    # A minimal HTTP/1.1 handler for the updates Telegram posts to the webhook. deliver(data, body) handles
+    # an update and returns the HTTP status to answer with.
+    webhook_requests.add(asyncio.current_task())
+    try:
+        try:
+            method, path, headers, body = await asyncio.wait_for(
+                read_http_request(reader, max_update_size), http_request_timeout
+            )
+            secret = headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1")
+            if method != "POST":
+                status = "405 Method Not Allowed"
+            elif not hmac.compare_digest(secret, webhook_secret.encode("latin-1")):
+                status = "403 Forbidden"
+            else:
+                status = await deliver(json.loads(body), body)
+        except ValueError:
+            status = "400 Bad Request"
+        await write_http_response(writer, status)
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        pass
+    except asyncio.CancelledError:
+        # Dropped when stopping. The connection's task ends here, asyncio would log its cancellation as an error.
+        pass
+    finally:
+        writer.close()
+        webhook_requests.discard(asyncio.current_task())
+
+class UpdateQueue(asyncio.Queue):
+    # The application's update queue, counting every update from when it's put in until it's processed. With
+    # concurrent_updates the application takes all updates out right away and processes them in their own tasks, so
+    # the queue's size says nothing about how many are still waiting. The application calls task_done() for every
+    # processed update.
+    def __init__(self):
+        super().__init__()
+        self.unfinished = 0
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.unfinished += 1
+
+    def task_done(self):
+        super().task_done()
+        self.unfinished -= 1
+
+async def queue_update(application, data, body):
+    # Hand the update to the application. When too many updates are unfinished, Telegram is told to send it again later.
+    if application.update_queue.unfinished >= webhook_queue_size:
+        return "503 Service Unavailable"
+    application.update_queue.put_nowait(Update.de_json(data, application.bot))
+    return "200 OK"
+
+def update_shard(data):
+    # The worker process answering an update. All updates of a chat go to the same worker, so its queue,
+    # selected model and chat log stay in one process. Updates without a chat go by their sender.
+    key = data.get("update_id", 0)
+    for value in data.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            sender = value.get("from") or value.get("user")
+            if chat or sender:
+                key = (chat or sender)["id"]
+                break
+    return key % webhook_workers
+
+async def forward_update(client, data, body):
+    # Pass the update on to its worker process and answer Telegram with the worker's status
+    port = webhook_port + 1 + update_shard(data)
+    try:
+        response = await client.post(
+            f"http://127.0.0.1:{port}/",
+            content=body,
+            headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": webhook_secret},
+        )
+    except httpx.HTTPError as e:
+        logging.warning("Could not pass an update on to the worker on port %s: %s", port, str(e))
+        return "502 Bad Gateway"
+    return f"{response.status_code} {response.reason_phrase}"
+
+def stop_signal():
+    # An event that is set on SIGINT or SIGTERM
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    return stopping
+
+async def stop_webhook_server(server):
+    # Stop accepting updates and wait for the ones that are being received, the ones that take too long are dropped.
+    # Telegram sends a dropped update again.
+    server.close()
+    if webhook_requests:
+        done, pending = await asyncio.wait(set(webhook_requests), timeout=webhook_drain_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await server.wait_closed()
+
+async def set_webhook(bot):
+    await bot.set_webhook(webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=webhook_secret)
+    logging.info("Receiving updates through the webhook at %s", webhook_url)
+
+async def run_webhook(application):
+    # Answer the updates posted to the webhook until SIGINT or SIGTERM, in the same order of steps as run_polling.
+    # A worker process only listens locally for the updates passed on to it.
+    stopping = stop_signal()
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    if webhook_worker is None:
+        host, port = webhook_host, webhook_port
+    else:
+        host, port = "127.0.0.1", webhook_port + 1 + webhook_worker
+    server = await asyncio.start_server(
+        functools.partial(receive_webhook, deliver=functools.partial(queue_update, application)), host, port
+    )
+    if webhook_worker is None:
+        await set_webhook(application.bot)
+    logging.info("Webhook server listening on %s:%s", host, port)
+
+    await stopping.wait()
+    # Answer everything that was received before stopping. The webhook stays set, so Telegram keeps
+    # the updates that arrive in the meantime until the bot is started again.
+    await stop_webhook_server(server)
+    await application.stop()
+    await on_stop(application)
+    await application.shutdown()
+    await on_shutdown(application)
+
+def start_webhook_worker(number):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=dict(os.environ, WEBHOOK_WORKER=str(number)))
+
+async def run_webhook_workers():
+    # Receive the updates and pass them on to WEBHOOK_WORKERS worker processes, restarting the ones that exit
+    stopping = stop_signal()
+    workers = [start_webhook_worker(number) for number in range(webhook_workers)]
+    client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=None))
+    server = await asyncio.start_server(
+        functools.partial(receive_webhook, deliver=functools.partial(forward_update, client)), webhook_host, webhook_port
+    )
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        await set_webhook(bot)
+    logging.info("Webhook server listening on %s:%s with %s workers", webhook_host, webhook_port, webhook_workers)
+
+    while not stopping.is_set():
+        for number, worker in enumerate(workers):
+            if worker.poll() is not None:
+                logging.warning("Webhook worker %s exited with code %s, restarting it", number, worker.returncode)
+                workers[number] = start_webhook_worker(number)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stopping.wait(), 5)
+
+    # Let the workers answer what they already received before they exit
+    await stop_webhook_server(server)
+    await client.aclose()
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        await run_blocking(worker.wait)
+
 if __name__ == "__main__":
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-
-    start_handler = CommandHandler("start", start)
-    reset_handler = CommandHandler("reset", reset)
-    purge_handler = CommandHandler("purge", purge)
-    select_handler = CommandHandler("select", select)
-    message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), process_message)
-    button_handler = CallbackQueryHandler(button_callback)
-    help_handler = CommandHandler("help", help_command)
-    set_cookie_handler = CommandHandler("setcookie", set_cookie)
-    restart_handler = CommandHandler("restart", restart_bot)
+    if webhook_url and webhook_workers > 1 and webhook_worker is None:
+        # This process only receives the updates, the worker processes answer them
+        asyncio.run(run_webhook_workers())
+        executor.shutdown(wait=False, cancel_futures=True)
+        stream_executor.shutdown(wait=False, cancel_futures=True)
+        sys.exit()
+
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(concurrent_updates)
+        # Counts the unfinished updates, the webhook refuses more than webhook_queue_size of them
+        .update_queue(UpdateQueue())
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # Every handler is timed for the metrics
+    access_handler = TypeHandler(Update, instrument("access", check_access))
+    start_handler = CommandHandler("start", instrument("start", start))
+    reset_handler = CommandHandler("reset", instrument("reset", reset))
+    purge_handler = CommandHandler("purge", instrument("purge", purge))
+    stop_handler = CommandHandler("stop", instrument("stop", stop))
+    select_handler = CommandHandler("select", instrument("select", select))
+    message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND) & bot_addressed, instrument("message", process_message))
+    button_handler = CallbackQueryHandler(instrument("button", button_callback))
+    help_handler = CommandHandler("help", instrument("help", help_command))
+    set_cookie_handler = CommandHandler("setcookie", instrument("setcookie", set_cookie))
+    restart_handler = CommandHandler("restart", instrument("restart", restart_bot))
+    reload_access_handler = CommandHandler("reloadaccess", instrument("reloadaccess", reload_access))
+    cache_handler = CommandHandler("cache", instrument("cache", cache))
+    compare_handler = CommandHandler("compare", instrument("compare", compare))
     #summarize_handler = CommandHandler("summarize", summarize)
-    imagine_handler = CommandHandler("imagine", imagine)
+    imagine_handler = CommandHandler("imagine", instrument("imagine", imagine))
 
+    # The access check runs before the handlers of group 0
+    application.add_handler(access_handler, group=-1)
     application.add_handler(start_handler)
     application.add_handler(reset_handler)
     application.add_handler(purge_handler)
+    application.add_handler(stop_handler)
     application.add_handler(select_handler)
     application.add_handler(message_handler)
     application.add_handler(button_handler)
     application.add_handler(help_handler)
     application.add_handler(set_cookie_handler)
     application.add_handler(restart_handler)
+    application.add_handler(reload_access_handler)
+    application.add_handler(cache_handler)
+    application.add_handler(compare_handler)
     #application.add_handler(summarize_handler)
     application.add_handler(imagine_handler)
 
-    application.run_polling()
\ No newline at end of file
+    if webhook_url:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
+    # Stop the worker threads once the bot has stopped
+    executor.shutdown(wait=False, cancel_futures=True)
+    stream_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,478 @@
+import os
+import re
+import sys
+import time
+import types
+import random
+import timeit
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Offline benchmarks for PoeTelegramBot.py.
+# The bot's own code is run against fake Poe and Telegram objects, so no tokens or network access are needed.
+# Usage: python benchmark.py streaming|escaping|imagine|load
+
+# The bot refuses to start without these, the values are never sent anywhere
+os.environ.setdefault("BOT_TOKEN", "123456:offline-benchmark")
+os.environ.setdefault("POE_COOKIE", "offline-benchmark")
+os.environ.setdefault("BING_AUTH_COOKIE", "offline-benchmark")
+# Keep the chat logs in memory, the benchmarks shouldn't leave files behind
+os.environ.setdefault("HISTORY_BACKEND", "none")
+
+import poe
+
+SAMPLE_REPLY = (
+    "Sure! Here is a short answer to your question. "
+    "The quick brown fox jumps over the lazy dog (twice), and then takes a nap. "
+) * 20
+
+def fake_poe_chunks(text, chunk_size=20, first_chunk_delay=0.5, chunk_delay=0.05):
+    # Yield chunks the way poe.Client.send_message does, with a delay before each one
+    time.sleep(first_chunk_delay)
+    for i in range(0, len(text), chunk_size):
+        if i:
+            time.sleep(chunk_delay)
+        yield {"text": text[:i + chunk_size], "text_new": text[i:i + chunk_size], "state": "incomplete"}
+
+class FakePoeClient:
+    # Stands in for poe.Client, answering every message with fake_poe_chunks. A share of error_rate messages fails.
+    reply = SAMPLE_REPLY
+    chunk_size = 20
+    first_chunk_delay = 0.5
+    chunk_delay = 0.05
+    error_rate = 0.0
+
+    def __init__(self, token, *args, **kwargs):
+        self.token = token
+        self.bot_names = {"capybara": "Sage", "a2": "Claude", "chinchilla": "ChatGPT"}
+
+    def send_message(self, chatbot, message, with_chat_break=False, timeout=20, **kwargs):
+        if random.random() < self.error_rate:
+            raise RuntimeError(f"Fake error from {chatbot}.")
+        return fake_poe_chunks(self.reply, self.chunk_size, self.first_chunk_delay, self.chunk_delay)
+
+    def get_bots(self):
+        time.sleep(self.first_chunk_delay)
+
+    def send_chat_break(self, chatbot):
+        pass
+
+    def purge_conversation(self, chatbot, count=-1):
+        pass
+
+# Patch the Poe client before the bot creates its own
+poe.Client = FakePoeClient
+
+import PoeTelegramBot as bot
+
+class FakeMessage(types.SimpleNamespace):
+    async def delete(self):
+        pass
+
+class FakeTelegramBot:
+    # Records every message and edit together with the time it was made
+    username = "BenchmarkBot"
+    id = 1
+    default_latency = 0.05
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.events = []
+        self.last_message_id = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.last_message_id += 1
+        self.events.append((time.perf_counter(), "send", chat_id, text))
+        return FakeMessage(chat_id=chat_id, message_id=self.last_message_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.events.append((time.perf_counter(), "edit", chat_id, text))
+        return True
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.events.append((time.perf_counter(), "media", chat_id, len(media)))
+        return []
+
+def make_update(text, chat_id=1, user_id=1, chat_type="private"):
+    user = types.SimpleNamespace(id=user_id, first_name="Bench", username="bench")
+    chat = types.SimpleNamespace(id=chat_id, type=chat_type)
+    message = FakeMessage(
+        text=text, from_user=user, chat=chat, chat_id=chat_id, message_id=1, entities=(), reply_to_message=None
+    )
+    return types.SimpleNamespace(
+        message=message,
+        edited_message=None,
+        effective_message=message,
+        effective_user=user,
+        effective_chat=chat,
+        callback_query=None,
+    )
+
+class FakeCallbackQuery:
+    def __init__(self, data):
+        self.data = data
+
+    async def answer(self, text=None, **kwargs):
+        pass
+
+def make_callback_update(data, chat_id=1, user_id=1):
+    update = make_update("", chat_id=chat_id, user_id=user_id)
+    update.message = update.effective_message = None
+    update.callback_query = FakeCallbackQuery(data)
+    return update
+
+def make_context(telegram_bot):
+    return types.SimpleNamespace(bot=telegram_bot, args=[])
+
+async def time_to_first_text(streaming):
+    # Time from receiving a message until the first part of the reply is visible, and until the full reply is shown
+    bot.stream_replies = streaming
+    telegram_bot = FakeTelegramBot()
+    started = time.perf_counter()
+    # A chat of its own, so the pacing of the previous run's messages doesn't delay this one
+    await bot.process_message(make_update("Hello!", chat_id=2 if streaming else 1), make_context(telegram_bot))
+    await bot.scheduler.join()
+    edits = [event[0] for event in telegram_bot.events if event[1] == "edit"]
+    return edits[0] - started, edits[-1] - started, len(edits)
+
+async def benchmark_streaming(args):
+    bot.stream_edit_interval = args.edit_interval
+    FakePoeClient.chunk_size = args.chunk_size
+    FakePoeClient.first_chunk_delay = args.first_chunk_delay
+    FakePoeClient.chunk_delay = args.chunk_delay
+
+    for streaming in (False, True):
+        first, last, edits = await time_to_first_text(streaming)
+        mode = "streaming" if streaming else "collected"
+        print(f"{mode:>10}: first text after {first:.3f}s, full reply after {last:.3f}s, {edits} edits")
+
+def legacy_escape(message_text):
+    # The chain of replaces process_message used before escape_markdown, kept to compare against
+    return (
+        message_text.replace("_", "\\_")
+        .replace("*", "\\*")
+        .replace("[", "\\[")
+        .replace("]", "\\]")
+        .replace("(", "\\(")
+        .replace(")", "\\)")
+        .replace("~", "\\~")
+        .replace(">", "\\>")
+        .replace("#", "\\#")
+        .replace("+", "\\+")
+        .replace("-", "\\-")
+        .replace("=", "\\=")
+        .replace("|", "\\|")
+        .replace("{", "\\{")
+        .replace("}", "\\}")
+        .replace(".", "\\.")
+        .replace("!", "\\!")
+    )
+
+REPLY_PARTS = [
+    "Sure! Here's how it works (in short): the client sends a request, and the server answers.\n",
+    "1. Install the package - `pip install example_package`.\n",
+    "2. Set `MAX_SIZE=10` in your *config* file; see [the docs](https://example.com/docs?page=1#setup).\n",
+    "```python\ndef add(a, b):\n    return a + b  # {a} + {b}\n\nprint(add(1, 2))\n```\n",
+    "> Note: values like 3.14, 1e-5 or x_1 != x_2 need care!\n",
+    "| Column | Value |\n|---|---|\n| a | 1 |\n",
+]
+
+def make_reply(size, seed=0):
+    # A reply of about `size` characters that looks like what the models answer with
+    parts = random.Random(seed)
+    reply = ""
+    while len(reply) < size:
+        reply += parts.choice(REPLY_PARTS)
+    return reply[:size]
+
+MARKDOWN_SPECIAL = set("_*[]()~`>#+-=|{}.!\\")
+
+def check_markdown(text, limit=None):
+    # Return the reason why Telegram wouldn't parse text as MarkdownV2 without formatting other than code, or None
+    if limit is not None and len(text) > limit:
+        return f"message is {len(text)} characters long"
+    i = 0
+    while i < len(text):
+        character = text[i]
+        if character == "\\":
+            if i + 1 >= len(text):
+                return "escape at the end"
+            i += 2
+        elif character == "`":
+            closing = "```" if text.startswith("```", i) else "`"
+            i += len(closing)
+            while not text.startswith(closing, i):
+                if i >= len(text):
+                    return "code is not closed"
+                if text[i] == "`":
+                    return "unescaped ` in code"
+                if text[i] == "\\":
+                    if i + 1 >= len(text) or text[i + 1] not in "`\\":
+                        return "invalid escape in code"
+                    i += 1
+                i += 1
+            i += len(closing)
+        elif character in MARKDOWN_SPECIAL:
+            return f"unescaped {character!r} at {i}"
+        else:
+            i += 1
+    return None
+
+def random_text(generator, length):
+    alphabet = "ab c\n" + "".join(MARKDOWN_SPECIAL) + "```"
+    return "".join(generator.choice(alphabet) for _ in range(length))
+
+async def benchmark_escaping(args):
+    # Check the output of escape_markdown and split_markdown on random and realistic replies
+    generator = random.Random(args.seed)
+    samples = [random_text(generator, generator.randint(0, 300)) for _ in range(args.checks)]
+    samples += [make_reply(size, seed) for seed in range(10) for size in (1024, 8192, 32768)]
+    for sample in samples:
+        for message in [bot.escape_markdown(sample)] + bot.split_markdown(sample, args.limit):
+            problem = check_markdown(message)
+            if problem:
+                raise AssertionError(f"{problem} when escaping {sample!r}")
+        for message in bot.split_markdown(sample, args.limit):
+            problem = check_markdown(message, args.limit)
+            if problem:
+                raise AssertionError(f"{problem} when splitting {sample!r}")
+    print(f"checked {len(samples)} replies, all valid MarkdownV2")
+
+    # Single pass alternatives to the replaces in escape_text, to see whether they'd be faster
+    translate_table = str.maketrans({character: "\\" + character for character in MARKDOWN_SPECIAL})
+    single_pass = re.compile(r"[_*\[\]()~`>#+\-=|{}.!\\]")
+    escapes = {
+        "replace chain": legacy_escape,
+        "str.translate": lambda reply: reply.translate(translate_table),
+        "re.sub": lambda reply: single_pass.sub(lambda match: "\\" + match.group(), reply),
+        "escape_markdown": bot.escape_markdown,
+        "split_markdown": bot.split_markdown,
+    }
+    for size in (1024, 4096, 16384, 32768):
+        reply = make_reply(size)
+        timings = []
+        for name, escape in escapes.items():
+            seconds = min(timeit.repeat(lambda: escape(reply), number=args.number, repeat=5)) / args.number
+            timings.append(f"{name} {seconds * 1e6:.0f} us")
+        print(f"{size // 1024:>3} KB: " + ", ".join(timings))
+
+# A tiny JPEG header followed by padding, the fake Telegram bot never looks at the image
+FAKE_IMAGE = b"\xff\xd8\xff\xe0" + bytes(100 * 1024)
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    # Serves FAKE_IMAGE for every path after `delay` seconds, like the Bing image server would
+    delay = 0.2
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(FAKE_IMAGE)))
+        self.end_headers()
+        self.wfile.write(FAKE_IMAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_image_server():
+    # Start the stub image server on a free local port and return its address
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+class FakeImageGen:
+    # Stands in for BingImageCreator.ImageGen, returning links to the stub image server
+    base_url = None
+    images = 4
+    generation_delay = 1.0
+
+    def __init__(self, auth_cookie, *args, **kwargs):
+        self.auth_cookie = auth_cookie
+
+    def get_images(self, prompt):
+        time.sleep(self.generation_delay)
+        return [f"{self.base_url}/{prompt}/{i}.jpeg" for i in range(self.images)]
+
+async def benchmark_imagine(args):
+    server, FakeImageGen.base_url = start_image_server()
+    StubImageHandler.delay = args.download_delay
+    FakeImageGen.images = args.images
+    FakeImageGen.generation_delay = args.generation_delay
+    bot.ImageGen = FakeImageGen
+
+    try:
+        telegram_bot = FakeTelegramBot()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            bot.imagine(make_update(f"/imagine cat {i}", chat_id=i), make_context(telegram_bot))
+            for i in range(args.requests)
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+        if bot.http_client is not None:
+            await bot.http_client.aclose()
+            bot.http_client = None
+
+    groups = [event for event in telegram_bot.events if event[1] == "media"]
+    photos = sum(event[3] for event in groups)
+    print(f"{args.requests} /imagine requests: {photos} photos in {len(groups)} media groups after {elapsed:.3f}s")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+async def measure_loop_lag(interval, lags):
+    # Record how late the event loop wakes up, blocking calls on the loop show up here
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+
+async def send_message_request(telegram_bot, chat_id):
+    # A text message, finished once its reply is shown
+    await bot.process_message(make_update(f"Hello from chat {chat_id}!", chat_id=chat_id), make_context(telegram_bot))
+    worker = bot.scheduler.workers.get(chat_id)
+    if worker is not None:
+        await worker
+
+async def send_imagine_request(telegram_bot, chat_id):
+    await bot.imagine(make_update(f"/imagine cat {chat_id}", chat_id=chat_id), make_context(telegram_bot))
+
+async def send_select_request(telegram_bot, chat_id):
+    # /select followed by pressing one of its buttons
+    context = make_context(telegram_bot)
+    await bot.select(make_update("/select", chat_id=chat_id), context)
+    await bot.button_callback(make_callback_update("a2", chat_id=chat_id), context)
+
+REQUESTS = {"message": send_message_request, "imagine": send_imagine_request, "select": send_select_request}
+
+def parse_mix(mix):
+    # "message=8,imagine=1,select=1" -> a list to pick request kinds from
+    kinds = []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in REQUESTS:
+            raise SystemExit(f"Unknown request kind {name!r}, use one of: {', '.join(REQUESTS)}")
+        kinds += [name] * int(weight or 1)
+    return kinds
+
+async def run_load(concurrency, total, kinds, generator):
+    # Send `total` requests with at most `concurrency` of them in flight, every request in its own chat
+    telegram_bot = FakeTelegramBot(latency=FakeTelegramBot.default_latency)
+    limit = asyncio.Semaphore(concurrency)
+    latencies = {kind: [] for kind in set(kinds)}
+    failures = 0
+    errors_before = sum(bot.errors_total.values.values())
+
+    async def one(chat_id, kind):
+        nonlocal failures
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await REQUESTS[kind](telegram_bot, chat_id)
+            except Exception:
+                failures += 1
+            latencies[kind].append(time.perf_counter() - started)
+
+    lags = []
+    lag_task = asyncio.ensure_future(measure_loop_lag(0.01, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(one(100000 + i, generator.choice(kinds)) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+
+    handled_errors = sum(bot.errors_total.values.values()) - errors_before
+    print(f"concurrency {concurrency:>3}: {total / elapsed:7.2f} requests/s, max loop lag {max(lags or [0]) * 1000:.0f}ms, "
+          f"{handled_errors + failures} errors")
+    for kind, values in sorted(latencies.items()):
+        if not values:
+            continue
+        print(
+            f"    {kind:>8}: {len(values):>4} requests, p50 {percentile(values, 0.5):.3f}s, "
+            f"p95 {percentile(values, 0.95):.3f}s, p99 {percentile(values, 0.99):.3f}s"
+        )
+
+async def benchmark_load(args):
+    # Drive the real handlers with rising concurrency against fake Poe, Bing and Telegram backends
+    if not args.rate_limit:
+        bot.cookie_limiter = bot.RateLimiter(0, 0)
+        bot.model_limiter = bot.RateLimiter(0, 0)
+    FakePoeClient.chunk_size = args.chunk_size
+    FakePoeClient.first_chunk_delay = args.first_chunk_delay
+    FakePoeClient.chunk_delay = args.chunk_delay
+    FakePoeClient.error_rate = args.error_rate
+    FakePoeClient.reply = SAMPLE_REPLY[:args.reply_length]
+    FakeTelegramBot.default_latency = args.telegram_latency
+    FakeImageGen.generation_delay = args.generation_delay
+    StubImageHandler.delay = args.download_delay
+    bot.ImageGen = FakeImageGen
+    # Errors are expected with --error-rate, they're counted instead of logged
+    bot.logging.getLogger().setLevel(bot.logging.CRITICAL)
+
+    server, FakeImageGen.base_url = start_image_server()
+    generator = random.Random(args.seed)
+    kinds = parse_mix(args.mix)
+    try:
+        for concurrency in args.concurrency:
+            await run_load(concurrency, max(args.requests, concurrency), kinds, generator)
+            # Forget the chats of this round, so every round starts the same way
+            bot.sessions.reset()
+    finally:
+        server.shutdown()
+        if bot.http_client is not None:
+            await bot.http_client.aclose()
+            bot.http_client = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Poe Telegram bot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    streaming = commands.add_parser("streaming", help="Compare streamed and collected replies.")
+    streaming.add_argument("--chunk-size", type=int, default=20)
+    streaming.add_argument("--first-chunk-delay", type=float, default=0.5)
+    streaming.add_argument("--chunk-delay", type=float, default=0.05)
+    streaming.add_argument("--edit-interval", type=float, default=bot.stream_edit_interval)
+    streaming.set_defaults(func=benchmark_streaming)
+
+    escaping = commands.add_parser("escaping", help="Check and time the MarkdownV2 escaping of replies.")
+    escaping.add_argument("--checks", type=int, default=2000, help="number of random replies to check")
+    escaping.add_argument("--limit", type=int, default=bot.max_message_length)
+    escaping.add_argument("--number", type=int, default=200, help="escapes per timing")
+    escaping.add_argument("--seed", type=int, default=1)
+    escaping.set_defaults(func=benchmark_escaping)
+
+    imagine = commands.add_parser("imagine", help="Run concurrent /imagine requests against a local stub image server.")
+    imagine.add_argument("--requests", type=int, default=5)
+    imagine.add_argument("--images", type=int, default=4, help="images per request")
+    imagine.add_argument("--generation-delay", type=float, default=1.0)
+    imagine.add_argument("--download-delay", type=float, default=0.2)
+    imagine.set_defaults(func=benchmark_imagine)
+
+    load = commands.add_parser("load", help="Drive the handlers at rising concurrency and report latency percentiles.")
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    load.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    load.add_argument("--mix", default="message=8,imagine=1,select=1", help="request kinds and their weights")
+    load.add_argument("--chunk-size", type=int, default=40)
+    load.add_argument("--first-chunk-delay", type=float, default=0.3)
+    load.add_argument("--chunk-delay", type=float, default=0.02)
+    load.add_argument("--reply-length", type=int, default=600)
+    load.add_argument("--error-rate", type=float, default=0.0, help="share of Poe requests that fail")
+    load.add_argument("--telegram-latency", type=float, default=0.05)
+    load.add_argument("--generation-delay", type=float, default=1.0, help="seconds Bing takes per /imagine")
+    load.add_argument("--download-delay", type=float, default=0.1)
+    load.add_argument("--rate-limit", action="store_true", help="keep the Poe rate limits of the .env file")
+    load.add_argument("--seed", type=int, default=1)
+    load.set_defaults(func=benchmark_load)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+if __name__ == "__main__":
+    sys.exit(main())